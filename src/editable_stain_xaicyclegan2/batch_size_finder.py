@@ -0,0 +1,131 @@
+"""
+    Prevzatý kód
+"""
+
+import copy
+import gc
+import json
+import os
+from argparse import ArgumentParser
+
+import torch
+
+from editable_stain_xaicyclegan2.benchmark import run_benchmark, run_inference_benchmark
+from editable_stain_xaicyclegan2.setup.settings_module import Settings
+from editable_stain_xaicyclegan2.sweep import write_settings
+
+
+def is_out_of_memory(error: Exception) -> bool:
+    return isinstance(error, torch.cuda.OutOfMemoryError) or 'out of memory' in str(error).lower()
+
+
+def free_memory():
+    gc.collect()
+
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def find_batch_size(settings: Settings, mode: str = 'train', start: int = 1, max_batch_size: int = 1024,
+                    image_size: int = 256, warmup_steps: int = 2, steps: int = 3, memory_fraction: float = 0.9) -> dict:
+    """
+    Runs the training step (or generator inference) on synthetic data with batch sizes start, 2 * start, ...
+    until a batch runs out of memory, uses more than memory_fraction of the device memory or max_batch_size
+    is exceeded. Every batch size is measured with freshly built models, so the memory of a failed attempt is
+    released before the next one. Requires cuda, on the cpu there is neither an out of memory error nor a device
+    memory to compare with, so no limit could be found.
+
+    :param settings: settings of the run, mask type, filters, micro-batching etc. are taken into account
+    :param mode: 'train' measures training_step, 'inference' a translation with a single generator
+    :param start: first batch size to try
+    :param max_batch_size: largest batch size to try
+    :param image_size: width and height of the synthetic images, e.g. the crop size of the run
+    :param warmup_steps: untimed steps of every batch size, the first steps allocate the most memory
+    :param steps: timed steps of every batch size
+    :param memory_fraction: share of the cuda memory a batch size may use to be considered safe
+    :return: the largest safe batch size and the throughput of every tried batch size
+    """
+
+    if not torch.cuda.is_available():
+        raise RuntimeError("The batch size finder needs a cuda device, without one there is no memory limit to find")
+
+    benchmark = run_benchmark if mode == 'train' else run_inference_benchmark
+    total_memory = torch.cuda.get_device_properties(0).total_memory / 2 ** 20
+
+    curve = []
+    best = None
+    batch_size = start
+
+    while batch_size <= max_batch_size:
+        trial_settings = copy.copy(settings)
+        trial_settings.batch_size = batch_size
+        free_memory()
+        torch.cuda.reset_peak_memory_stats()
+
+        try:
+            results = benchmark(trial_settings, warmup_steps, steps, image_size)
+        except RuntimeError as e:
+            if not is_out_of_memory(e):
+                raise
+
+            curve.append({'batch_size': batch_size, 'status': 'out_of_memory'})
+            print(f"Batch size {batch_size}: out of memory")
+            break
+        finally:
+            free_memory()
+
+        # the peak over the whole attempt, including the allocations of the warmup steps
+        results['peak_memory_mib'] = torch.cuda.max_memory_allocated() / 2 ** 20
+        safe = results['peak_memory_mib'] <= memory_fraction * total_memory
+
+        curve.append({
+            'batch_size': batch_size,
+            'status': 'ok' if safe else 'over_memory_fraction',
+            'images_per_second': results['images_per_second'],
+            'steps_per_second': results['steps_per_second'],
+            'peak_memory_mib': results['peak_memory_mib']
+        })
+        print(f"Batch size {batch_size}: {results['images_per_second']:.2f} images/s, "
+              f"{results['peak_memory_mib']:.0f} MiB")
+
+        if not safe:
+            break
+
+        best = batch_size
+        batch_size *= 2
+
+    return {'mode': mode, 'image_size': image_size, 'batch_size': best, 'curve': curve}
+
+
+def main():
+    parser = ArgumentParser(description='Finds the largest batch size that fits into memory, on synthetic data.')
+    parser.add_argument('--settings', type=str, default='settings.cfg', help='Settings file of the run')
+    parser.add_argument('--mode', type=str, default='train', choices=['train', 'inference'], help='Path to probe')
+    parser.add_argument('--start', type=int, default=1, help='First batch size to try')
+    parser.add_argument('--max_batch_size', type=int, default=1024, help='Largest batch size to try')
+    parser.add_argument('--image_size', type=int, help='Size of the synthetic images, by default crop or size')
+    parser.add_argument('--memory_fraction', type=float, default=0.9, help='Share of cuda memory a batch may use')
+    parser.add_argument('--write', type=str, help='Write the batch size into this settings file, '
+                                                  'batch_size for train and validation_batch_size for inference')
+    parser.add_argument('--output', type=str, help='Also write the results as json to this file')
+    args = parser.parse_args()
+
+    settings = Settings(args.settings)
+    image_size = args.image_size or settings.crop or settings.size
+
+    results = find_batch_size(settings, args.mode, args.start, args.max_batch_size, image_size,
+                              memory_fraction=args.memory_fraction)
+    print(json.dumps(results, indent=4))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=4)
+
+    if args.write and results['batch_size'] is not None:
+        name = 'batch_size' if args.mode == 'train' else 'validation_batch_size'
+        write_settings(args.write, args.write, {name: results['batch_size']})
+        print(f"{name}={results['batch_size']} written to {os.path.abspath(args.write)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+"""
+    Prevzatý kód
+"""
+
+import json
+import os
+import resource
+import sys
+import time
+import types
+from argparse import ArgumentParser
+
+import kornia
+import torch
+
+from editable_stain_xaicyclegan2.model.dataset import DatasetFromFolder, DeviceLabTransform, LabNormalize, ToUint8Tensor
+from editable_stain_xaicyclegan2.model.mask import get_mask
+from editable_stain_xaicyclegan2.model.model import Generator
+from editable_stain_xaicyclegan2.model.training_controller import TrainingController
+from editable_stain_xaicyclegan2.setup.logging_utils import PhaseTimer, RunningMeanStack
+from editable_stain_xaicyclegan2.setup.settings_module import Settings
+
+
+class StubWandbModule:
+    """
+    Stands in for WandbModule when training without wandb, e.g. for benchmarking.
+    Keeps the running loss averages the training step appends to, everything else is a no-op.
+    """
+
+    def __init__(self, settings: Settings):
+        """
+        :param settings: settings of the run
+        """
+
+        self.run = types.SimpleNamespace(watch=lambda *args, **kwargs: None, log=lambda *args, **kwargs: None)
+
+        self.step = 0
+        self.log_frequency = settings.log_frequency
+
+        self.generator_he_to_p63_running_loss_avg = RunningMeanStack(self.log_frequency)
+        self.generator_p63_to_he_running_loss_avg = RunningMeanStack(self.log_frequency)
+        self.discriminator_he_running_loss_avg = RunningMeanStack(self.log_frequency)
+        self.discriminator_p63_running_loss_avg = RunningMeanStack(self.log_frequency)
+        self.cycle_he_running_loss_avg = RunningMeanStack(self.log_frequency)
+        self.cycle_p63_running_loss_avg = RunningMeanStack(self.log_frequency)
+        self.total_running_loss_avg = RunningMeanStack(self.log_frequency)
+        self.scheduled_total_running_loss_avg = RunningMeanStack(self.log_frequency)
+        self.context_running_loss_avg = RunningMeanStack(self.log_frequency)
+        self.cycle_context_running_loss_avg = RunningMeanStack(self.log_frequency)
+
+    def log(self, epoch, timings: dict | None = None):
+        pass
+
+    def log_validation(self, metrics: dict):
+        pass
+
+    def log_loss_schedule(self, stats: dict):
+        pass
+
+    def log_tile_cache(self, stats: dict):
+        pass
+
+    def close(self):
+        pass
+
+
+# a batch of random RGB images converted the same way as DefaultTransform does it, i.e. normalized LAB,
+# or left as uint8 as ToUint8Tensor ships them when the conversion runs on the device
+def get_synthetic_batch(batch_size, size, generator=None, uint8=False):
+    if uint8:
+        return torch.randint(0, 256, (batch_size, 3, size, size), dtype=torch.uint8, generator=generator)
+
+    rgb = torch.rand((batch_size, 3, size, size), generator=generator)
+    lab = kornia.color.rgb_to_lab(rgb)
+    lab_normalize = LabNormalize()
+
+    return torch.stack([lab_normalize(image) for image in lab])
+
+
+# peak memory in MiB, allocated by torch on cuda, peak resident set size of the process on cpu
+def get_peak_memory(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # kilobytes on linux, bytes on macos
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+# run warmup_steps untimed and steps timed calls of step_function, cycling through the batches, returns seconds
+def time_steps(step_function, batches, warmup_steps, steps, device):
+    def synchronize():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    for step in range(warmup_steps):
+        step_function(*batches[step % len(batches)])
+
+    synchronize()
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+    start = time.perf_counter()
+
+    for step in range(steps):
+        step_function(*batches[step % len(batches)])
+
+    synchronize()
+    return time.perf_counter() - start
+
+
+def run_benchmark(settings: Settings, warmup_steps: int = 3, steps: int = 10, image_size: int = 256,
+                  num_batches: int = 2, seed: int = 0) -> dict:
+    """
+    Runs warmup_steps and then steps timed training steps on synthetic data.
+
+    :param settings: training settings, the data paths are not used
+    :param warmup_steps: number of untimed steps, e.g. for cudnn autotuning and allocator warmup
+    :param steps: number of timed steps
+    :param image_size: width and height of the synthetic images
+    :param num_batches: number of distinct synthetic batches to cycle through
+    :param seed: seed of the synthetic data and the model initialization
+    :return: throughput and peak memory of the timed steps
+    """
+
+    torch.manual_seed(seed)
+    generator = torch.Generator().manual_seed(seed)
+
+    training_controller = TrainingController(settings, StubWandbModule(settings), load_data=False)
+    device = training_controller.device
+    pin_memory = device.type == 'cuda'
+
+    batches = [
+        tuple(get_synthetic_batch(settings.batch_size, image_size, generator, settings.device_transform)
+              for _ in range(2))
+        for _ in range(num_batches)
+    ]
+
+    if pin_memory:
+        batches = [(real_he.pin_memory(), real_p63.pin_memory()) for real_he, real_p63 in batches]
+
+    def training_step(real_he, real_p63):
+        # phase means over the timed steps only
+        if training_controller.global_step == warmup_steps:
+            training_controller.timer = PhaseTimer(settings.time_phases, max(steps, 1), device.type == 'cuda')
+
+        training_controller.training_step(real_he, real_p63)
+
+    elapsed = time_steps(training_step, batches, warmup_steps, steps, device)
+
+    results = {
+        'mode': 'train',
+        'device': str(device),
+        'batch_size': settings.batch_size,
+        'image_size': image_size,
+        'generator_downconv_filters': settings.generator_downconv_filters,
+        'discriminator_downconv_filters': settings.discriminator_downconv_filters,
+        'num_resnet_blocks': settings.num_resnet_blocks,
+        'mask_type': settings.mask_type,
+        'micro_batch_size': settings.micro_batch_size,
+        'device_transform': settings.device_transform,
+        'warmup_steps': warmup_steps,
+        'steps': steps,
+        'seconds': elapsed,
+        'steps_per_second': steps / elapsed,
+        # a step trains on batch_size images of each domain
+        'images_per_second': 2 * settings.batch_size * steps / elapsed,
+        'peak_memory_mib': get_peak_memory(device),
+        'peak_memory_kind': 'cuda_allocated' if device.type == 'cuda' else 'max_rss'
+    }
+
+    if settings.time_phases:
+        results['phase_seconds'] = training_controller.timer.means()
+
+    return results
+
+
+def run_inference_benchmark(settings: Settings, warmup_steps: int = 3, steps: int = 10, image_size: int = 256,
+                            num_batches: int = 2, seed: int = 0) -> dict:
+    """
+    Runs warmup_steps and then steps timed translations of a batch of settings.batch_size synthetic images,
+    including the mask creation, with a single generator in inference mode.
+
+    :param settings: model settings, the data paths are not used
+    :param warmup_steps: number of untimed steps
+    :param steps: number of timed steps
+    :param image_size: width and height of the synthetic images
+    :param num_batches: number of distinct synthetic batches to cycle through
+    :param seed: seed of the synthetic data and the model initialization
+    :return: throughput and peak memory of the timed steps
+    """
+
+    torch.manual_seed(seed)
+    generator = torch.Generator().manual_seed(seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    model = Generator(settings.generator_downconv_filters, settings.num_resnet_blocks, settings.channels,
+                      settings.channels)
+    model = model.to(device).to(memory_format=torch.channels_last).eval()
+
+    device_transform = DeviceLabTransform()
+    batches = [(get_synthetic_batch(settings.batch_size, image_size, generator, settings.device_transform),)
+               for _ in range(num_batches)]
+
+    if device.type == 'cuda':
+        batches = [(images.pin_memory(),) for images, in batches]
+
+    @torch.inference_mode()
+    def translate(images):
+        images = device_transform(images.to(device, non_blocking=True)).to(memory_format=torch.channels_last)
+        mask = get_mask(images, settings.mask_type).to(device).to(memory_format=torch.channels_last)
+        return model(images, mask)
+
+    elapsed = time_steps(translate, batches, warmup_steps, steps, device)
+
+    return {
+        'mode': 'inference',
+        'device': str(device),
+        'batch_size': settings.batch_size,
+        'image_size': image_size,
+        'generator_downconv_filters': settings.generator_downconv_filters,
+        'num_resnet_blocks': settings.num_resnet_blocks,
+        'mask_type': settings.mask_type,
+        'device_transform': settings.device_transform,
+        'warmup_steps': warmup_steps,
+        'steps': steps,
+        'seconds': elapsed,
+        'steps_per_second': steps / elapsed,
+        'images_per_second': settings.batch_size * steps / elapsed,
+        'peak_memory_mib': get_peak_memory(device),
+        'peak_memory_kind': 'cuda_allocated' if device.type == 'cuda' else 'max_rss'
+    }
+
+
+def run_decode_benchmark(settings: Settings, samples: int = 256, resize: int = 256) -> dict:
+    """
+    Measures the time per sample of DatasetFromFolder on the first samples tiles of data_train_he, with the PIL
+    and the torchvision decode backend, producing normalized LAB float images and uint8 images for
+    device_transform. The tiles are read once before timing, so the files are in the page cache.
+
+    :param settings: settings with the data paths
+    :param samples: number of tiles to decode
+    :param resize: size the tiles are resized to, the resize is skipped for tiles of this size
+    :return: seconds per sample of every combination and the largest difference of the LAB images of the backends
+    """
+
+    results = {'mode': 'decode', 'folder': settings.data_train_he, 'resize': resize}
+    images = {}
+
+    for backend in ('pil', 'torchvision'):
+        for output, transform in (('float', None), ('uint8', ToUint8Tensor())):
+            dataset = DatasetFromFolder(settings.data_root, settings.data_train_he, settings.norm_dict, transform,
+                                        resize=resize, decode_backend=backend)
+            indices = range(min(samples, len(dataset)))
+
+            for i in indices:
+                dataset[i]
+
+            start = time.perf_counter()
+            decoded = [dataset[i] for i in indices]
+            results[f'{backend}_{output}_seconds_per_sample'] = (time.perf_counter() - start) / len(indices)
+
+            if output == 'float':
+                images[backend] = torch.stack(decoded)
+
+    results['max_difference'] = (images['pil'] - images['torchvision']).abs().max().item()
+    return results
+
+
+def main():
+    parser = ArgumentParser(description='Measures training throughput on synthetic data, without a dataset or wandb.')
+    parser.add_argument('--settings', type=str, default='settings.cfg', help='Settings file to start from')
+    parser.add_argument('--warmup_steps', type=int, default=3, help='Number of untimed steps')
+    parser.add_argument('--steps', type=int, default=10, help='Number of timed steps')
+    parser.add_argument('--batch_size', type=int, help='Overrides batch_size')
+    parser.add_argument('--image_size', type=int, default=256, help='Width and height of the synthetic images')
+    parser.add_argument('--generator_filters', type=int, help='Overrides generator_downconv_filters')
+    parser.add_argument('--discriminator_filters', type=int, help='Overrides discriminator_downconv_filters')
+    parser.add_argument('--resnet_blocks', type=int, help='Overrides num_resnet_blocks')
+    parser.add_argument('--mask_type', type=str, choices=['binary_rec', 'entropy', 'noise'], help='Overrides mask_type')
+    parser.add_argument('--micro_batch_size', type=int, help='Overrides micro_batch_size')
+    parser.add_argument('--device_transform', action='store_true', help='Ship uint8 batches and convert them to '
+                                                                        'LAB on the device')
+    parser.add_argument('--time_phases', action='store_true', help='Also report the mean time of each phase')
+    parser.add_argument('--inference', action='store_true', help='Measure generator inference instead of training')
+    parser.add_argument('--decode', action='store_true', help='Measure the decode time per sample of data_train_he '
+                                                              'with both decode backends instead')
+    parser.add_argument('--decode_samples', type=int, default=256, help='Number of tiles to decode')
+    parser.add_argument('--cpu', action='store_true', help='Run on cpu even if cuda is available')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data and the models')
+    parser.add_argument('--output', type=str, help='Also append the results as a json line to this file')
+    args = parser.parse_args()
+
+    if args.cpu:  # must happen before cuda is initialized
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    settings = Settings(args.settings)
+
+    overrides = {
+        'batch_size': args.batch_size,
+        'generator_downconv_filters': args.generator_filters,
+        'discriminator_downconv_filters': args.discriminator_filters,
+        'num_resnet_blocks': args.resnet_blocks,
+        'mask_type': args.mask_type,
+        'micro_batch_size': args.micro_batch_size
+    }
+
+    for name, value in overrides.items():
+        if value is not None:
+            setattr(settings, name, value)
+
+    settings.time_phases = settings.time_phases or args.time_phases
+    settings.device_transform = settings.device_transform or args.device_transform
+
+    if args.decode:
+        results = run_decode_benchmark(settings, args.decode_samples, args.image_size)
+    else:
+        benchmark = run_inference_benchmark if args.inference else run_benchmark
+        results = benchmark(settings, args.warmup_steps, args.steps, args.image_size, seed=args.seed)
+
+    line = json.dumps(results)
+    print(line)
+
+    if args.output:
+        with open(args.output, 'a') as file:
+            file.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+    Prevzatý kód
+"""
+
+import io
+import os
+import re
+import time
+import zlib
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from editable_stain_xaicyclegan2.model.dataset import get_manifest_path
+from editable_stain_xaicyclegan2.setup.settings_module import Settings
+
+# tiles are named {vsi}_{x}_{y}.png by prepare_dataset.py, the slide name itself may contain underscores
+TILE_NAME = re.compile(r'^(?P<slide>.+)_(?P<x>\d+)_(?P<y>\d+)\.png$')
+
+
+# slide name and coordinates of a tile, the name without extension and -1, -1 if it does not follow the pattern
+def parse_tile_name(filename: str) -> tuple[str, int, int]:
+    match = TILE_NAME.match(filename)
+
+    if match is None:
+        return os.path.splitext(filename)[0], -1, -1
+
+    return match.group('slide'), int(match.group('x')), int(match.group('y'))
+
+
+# fully decodes a tile from a single read, returns its file size, crc32 checksum, width and height,
+# None if the tile is unreadable
+def validate_tile(path: str):
+    try:
+        with open(path, 'rb') as file:
+            content = file.read()
+
+        with Image.open(io.BytesIO(content)) as img:
+            img.convert('RGB').load()
+            width, height = img.size
+    except (OSError, SyntaxError) as e:
+        print(f"{path}: {e}")
+        return None
+
+    return len(content), zlib.crc32(content), width, height
+
+
+def build_manifest(image_dir: str, sub_folder: str, workers: int = None, chunk_size: int = 256,
+                   delete_invalid: bool = False) -> dict[str, np.ndarray]:
+    """
+    Validates every tile of a folder once, in parallel, and writes the manifest DatasetFromFolder loads with
+    manifest=True instead of listing the folder. The manifest is a single uncompressed .npz of flat arrays,
+    see load_manifest.
+
+    :param image_dir: path to the folder containing the tile folders
+    :param sub_folder: tile folder to index, e.g. 'train/p63'
+    :param workers: number of validating processes, by default the number of cpus
+    :param chunk_size: number of tiles validated at once by a worker
+    :param delete_invalid: delete the unreadable tiles, as DatasetFromFolder does while training
+    :return: the arrays of the manifest
+    """
+
+    input_path = os.path.join(image_dir, sub_folder)
+    filenames = sorted(os.listdir(input_path))
+    paths = [os.path.join(input_path, filename) for filename in filenames]
+
+    valid = []
+    invalid = []
+    stats = []
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for filename, path, result in zip(filenames, paths, executor.map(validate_tile, paths, chunksize=chunk_size)):
+            if result is None:
+                invalid.append(filename)
+
+                if delete_invalid:
+                    os.remove(path)
+            else:
+                valid.append(filename)
+                stats.append(result)
+
+    tiles = [parse_tile_name(filename) for filename in valid]
+    slides, slide_index = np.unique(np.array([slide for slide, _, _ in tiles], dtype=str), return_inverse=True)
+    stats = np.array(stats, dtype=np.int64).reshape(-1, 4)
+
+    manifest = {
+        'filenames': np.array([filename.encode() for filename in valid], dtype=bytes),
+        'file_size': stats[:, 0],
+        'checksum': stats[:, 1].astype(np.uint32),
+        'width': stats[:, 2].astype(np.int32),
+        'height': stats[:, 3].astype(np.int32),
+        'slides': np.array([slide.encode() for slide in slides], dtype=bytes),
+        'slide': slide_index.astype(np.int32),
+        'x': np.array([x for _, x, _ in tiles], dtype=np.int32),
+        'y': np.array([y for _, _, y in tiles], dtype=np.int32),
+        'invalid': np.array([filename.encode() for filename in invalid], dtype=bytes)
+    }
+
+    # written under a temporary name, a half written manifest is never picked up by training
+    manifest_path = get_manifest_path(image_dir, sub_folder)
+    partial_path = manifest_path + '.partial.npz'
+    np.savez(partial_path, **manifest)
+    os.replace(partial_path, manifest_path)
+
+    return manifest
+
+
+def main():
+    parser = ArgumentParser(description='Validates tile folders once and writes the manifests used by training '
+                                        'with data_manifest=True.')
+    parser.add_argument('--settings', type=str, default='settings.cfg', help='Settings file with the data paths')
+    parser.add_argument('--folders', type=str, nargs='+', help='Tile folders in data_root to index, by default '
+                                                               'the train and test folders of the settings')
+    parser.add_argument('--workers', type=int, help='Number of validating processes')
+    parser.add_argument('--delete_invalid', action='store_true', help='Delete the unreadable tiles')
+    args = parser.parse_args()
+
+    settings = Settings(args.settings)
+    folders = args.folders or [settings.data_train_he, settings.data_train_p63,
+                               settings.data_test_he, settings.data_test_p63]
+
+    for folder in folders:
+        start = time.perf_counter()
+        manifest = build_manifest(settings.data_root, folder, args.workers, delete_invalid=args.delete_invalid)
+        elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        np.load(get_manifest_path(settings.data_root, folder))['filenames']
+        load_time = time.perf_counter() - start
+
+        print(f"{folder}: {len(manifest['filenames'])} tiles of {len(manifest['slides'])} slides, "
+              f"{len(manifest['invalid'])} invalid, indexed in {elapsed:.1f} s, loads in {1000 * load_time:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
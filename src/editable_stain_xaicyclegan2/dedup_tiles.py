@@ -0,0 +1,219 @@
+"""
+    Prevzatý kód
+"""
+
+import json
+import os
+import shutil
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from editable_stain_xaicyclegan2.build_manifest import build_manifest
+from editable_stain_xaicyclegan2.model.dataset import get_manifest_path, load_manifest
+from editable_stain_xaicyclegan2.setup.settings_module import Settings
+
+HASH_BITS = 64
+BIT_WEIGHTS = (1 << np.arange(HASH_BITS, dtype=np.uint64)).astype(np.uint64)
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+# number of set bits of every uint64
+def popcount(values: np.ndarray) -> np.ndarray:
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+
+    return POPCOUNT_TABLE[values.view(np.uint8).reshape(*values.shape, 8)].sum(axis=-1)
+
+
+# packs (N, 64) booleans into N uint64 hashes
+def pack_bits(bits: np.ndarray) -> np.ndarray:
+    return (bits.reshape(len(bits), HASH_BITS).astype(np.uint64) * BIT_WEIGHTS).sum(axis=1, dtype=np.uint64)
+
+
+# orthonormal DCT-II matrix of size n
+def dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n).reshape(-1, 1)
+    matrix = np.cos(np.pi * (2 * np.arange(n) + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+# difference hash, whether each pixel of a 9x8 thumbnail is brighter than its right neighbour
+def dhash(thumbnails: np.ndarray) -> np.ndarray:
+    return pack_bits(thumbnails[:, :, 1:] > thumbnails[:, :, :-1])
+
+
+# perceptual hash, whether each of the 8x8 lowest frequencies of the DCT of a 32x32 thumbnail is above their median
+def phash(thumbnails: np.ndarray) -> np.ndarray:
+    dct = dct_matrix(thumbnails.shape[-1])
+    frequencies = (dct @ thumbnails @ dct.T)[:, :8, :8].reshape(len(thumbnails), -1)
+    median = np.median(frequencies[:, 1:], axis=1, keepdims=True)  # without the DC term, which is the brightness
+    return pack_bits(frequencies > median)
+
+
+HASHES = {'dhash': (dhash, (9, 8)), 'phash': (phash, (32, 32))}
+
+
+# hashes of a chunk of tiles, the tiles are decoded one by one and hashed together
+def hash_tiles(paths: list[str], method: str = 'dhash') -> np.ndarray:
+    function, size = HASHES[method]
+    thumbnails = np.stack([np.asarray(Image.open(path).convert('L').resize(size, Image.BILINEAR), dtype=np.float32)
+                           for path in paths])
+    return function(thumbnails)
+
+
+def find_duplicates(hashes: np.ndarray, max_distance: int = 4, max_block: int = 4096) -> np.ndarray:
+    """
+    Finds the groups of near-duplicate tiles with a multi-index search. Identical hashes, e.g. of empty tiles, are
+    merged first, the distinct hashes are then split into max_distance + 1 blocks. By the pigeonhole principle two
+    hashes within max_distance bits agree on at least one block, so only hashes sharing a block value are compared.
+    Duplicates are grouped transitively.
+
+    :param hashes: uint64 hash of every tile
+    :param max_distance: largest Hamming distance of near-duplicates
+    :param max_block: compare the hashes sharing a block value in blocks of at most this many rows and columns,
+     bounds the memory use
+    :return: for every tile the index of the tile representing its group, the lowest index of the group
+    """
+
+    distinct, inverse = np.unique(hashes, return_inverse=True)
+    count = len(distinct)
+    parent = np.arange(count)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    bounds = np.linspace(0, HASH_BITS, max_distance + 2).astype(int)
+
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        keys = (distinct >> np.uint64(start)) & np.uint64((1 << int(end - start)) - 1)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        bucket_starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        bucket_ends = np.r_[bucket_starts[1:], count]
+        shared = bucket_ends - bucket_starts > 1
+
+        for bucket_start, bucket_end in zip(bucket_starts[shared], bucket_ends[shared]):
+            members = order[bucket_start:bucket_end]
+
+            # every pair of the bucket once, in blocks of rows against the same and the following columns
+            for row_start in range(0, len(members), max_block):
+                rows = members[row_start:row_start + max_block]
+
+                for column_start in range(row_start, len(members), max_block):
+                    columns = members[column_start:column_start + max_block]
+                    distances = popcount(distinct[rows, None] ^ distinct[None, columns])
+                    row_index, column_index = np.nonzero(distances <= max_distance)
+
+                    for i, j in zip(rows[row_index], columns[column_index]):
+                        root_i, root_j = find(i), find(j)
+
+                        if root_i != root_j:
+                            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    # the lowest tile index of every group represents it
+    roots = np.array([find(i) for i in range(count)], dtype=np.int64)[inverse.reshape(-1)]
+    first = np.full(count, len(hashes), dtype=np.int64)
+    np.minimum.at(first, roots, np.arange(len(hashes)))
+
+    return first[roots]
+
+
+def dedup_tiles(image_dir: str, sub_folder: str, method: str = 'dhash', max_distance: int = 4,
+                workers: int = None, chunk_size: int = 256) -> dict:
+    """
+    Hashes the tiles of a folder in parallel and prunes its manifest to one tile of every group of near-duplicates,
+    so that training with data_manifest=True skips the rest. The tiles are not deleted, the unpruned manifest is
+    kept as <folder>.manifest.full.npz and used by later runs. A manifest is built first if the folder has none.
+
+    :param image_dir: path to the folder containing the tile folders
+    :param sub_folder: tile folder to deduplicate, e.g. 'train/p63'
+    :param method: 'dhash' or 'phash'
+    :param max_distance: largest Hamming distance of the 64 bit hashes of near-duplicates
+    :param workers: number of hashing processes
+    :param chunk_size: number of tiles hashed at once by a worker
+    :return: number of tiles before and after the pruning
+    """
+
+    manifest_path = get_manifest_path(image_dir, sub_folder)
+    full_path = manifest_path.replace('.manifest.npz', '.manifest.full.npz')
+
+    if not os.path.exists(full_path):
+        if not os.path.exists(manifest_path):
+            build_manifest(image_dir, sub_folder, workers)
+
+        shutil.copyfile(manifest_path, full_path)
+
+    with np.load(full_path, allow_pickle=False) as full:
+        manifest = dict(full)
+
+    input_path = os.path.join(image_dir, sub_folder)
+    filenames = np.char.decode(manifest['filenames']).tolist()
+    paths = [os.path.join(input_path, filename) for filename in filenames]
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        hashes = np.concatenate([np.zeros(0, dtype=np.uint64)] +
+                                list(executor.map(hash_tiles, chunks, [method] * len(chunks))))
+
+    representatives = find_duplicates(hashes, max_distance)
+    keep = representatives == np.arange(len(filenames))
+
+    # per tile arrays are pruned, the slide names and the invalid tiles are kept as they are
+    pruned = {name: values[keep] if name not in ('slides', 'invalid') else values for name, values in manifest.items()}
+    pruned['duplicates'] = manifest['filenames'][~keep]
+    pruned['duplicate_of'] = manifest['filenames'][representatives[~keep]]
+    pruned['hash'] = hashes[keep]
+
+    partial_path = manifest_path + '.partial.npz'
+    np.savez(partial_path, **pruned)
+    os.replace(partial_path, manifest_path)
+
+    return {'folder': sub_folder, 'tiles': len(filenames), 'kept': int(keep.sum()),
+            'duplicates': int((~keep).sum())}
+
+
+def main():
+    parser = ArgumentParser(description='Prunes near-duplicate tiles from the manifests of the train folders, '
+                                        'used by training with data_manifest=True.')
+    parser.add_argument('--settings', type=str, default='settings.cfg', help='Settings file with the data paths')
+    parser.add_argument('--folders', type=str, nargs='+', help='Tile folders in data_root to deduplicate, '
+                                                               'by default data_train_he and data_train_p63')
+    parser.add_argument('--method', type=str, default='dhash', choices=list(HASHES), help='Perceptual hash')
+    parser.add_argument('--max_distance', type=int, default=4, help='Largest Hamming distance of near-duplicates')
+    parser.add_argument('--workers', type=int, help='Number of hashing processes')
+    parser.add_argument('--output', type=str, help='Also write the report as json to this file')
+    args = parser.parse_args()
+
+    settings = Settings(args.settings)
+    folders = args.folders or [settings.data_train_he, settings.data_train_p63]
+
+    results = [dedup_tiles(settings.data_root, folder, args.method, args.max_distance, args.workers)
+               for folder in folders]
+
+    for result in results:
+        print(f"{result['folder']}: {result['duplicates']} of {result['tiles']} tiles are near-duplicates, "
+              f"{result['kept']} kept")
+
+    # an epoch is one pass over the larger domain, see TrainingController, the step time is unchanged
+    report = {'method': args.method, 'max_distance': args.max_distance, 'folders': results}
+
+    if settings.steps_per_epoch is None:
+        report['epoch_time_reduction'] = 1 - max(r['kept'] for r in results) / max(max(r['tiles'] for r in results), 1)
+        print(f"Estimated epoch time reduction: {100 * report['epoch_time_reduction']:.1f} %")
+    else:
+        print("steps_per_epoch is fixed, the epoch time is unchanged, the epochs cover fewer duplicates instead")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,7 @@ from torchmetrics.image import MemorizationInformedFrechetInceptionDistance, Uni
 
 from editable_stain_xaicyclegan2.model.training_controller import TrainingController
 from editable_stain_xaicyclegan2.setup.logging_utils import normalize_image
+from editable_stain_xaicyclegan2.setup.profiler_module import ProfilerModule
 from editable_stain_xaicyclegan2.setup.settings_module import Settings
 
 
@@ -21,7 +22,8 @@ if __name__ == '__main__':
     except FileNotFoundError:
         saved_params = torch.load(f'.mnt/scratch/models/Experiment {num_exp}/9_model_checkpoint.pth')
     
-    training_controller = TrainingController(Settings('settings.cfg'), None, saved_params)
+    settings = Settings('settings.cfg')
+    training_controller = TrainingController(settings, None, saved_params)
 
     ssim = StructuralSimilarityIndexMeasure(data_range=1.0).to('cuda')
     psnr = PeakSignalNoiseRatio(data_range=1.0).to('cuda')
@@ -38,8 +40,11 @@ if __name__ == '__main__':
 
     testlen = min(len(training_controller.test_he), len(training_controller.test_p63))
 
-    with torch.inference_mode():
+    with torch.inference_mode(), ProfilerModule(settings, 'eval') as profiler:
         for (real_he, real_p63) in tqdm(zip(training_controller.test_he, training_controller.test_p63), total=testlen):
+            # uint8 batches of device_transform are converted once, the metrics below need the normalized LAB images
+            real_he = training_controller.device_transform(real_he.to(training_controller.device))
+            real_p63 = training_controller.device_transform(real_p63.to(training_controller.device))
             fake_he, cycled_he, fake_p63, cycled_p63 = training_controller.eval_step(real_he, real_p63)
 
             fake_he_norm = normalize_image(fake_he, return_numpy=False, permute=False, squeeze=False).to('cuda')
@@ -71,6 +76,7 @@ if __name__ == '__main__':
             psnr_vals_p63.append(psnr(cycled_p63_unit, real_p63_unit).cpu().numpy())
             uiqi_vals_he.append(uiqi(cycled_he_unit, real_he_unit).cpu().numpy())
             uiqi_vals_p63.append(uiqi(cycled_p63_unit, real_p63_unit).cpu().numpy())
+            profiler.step()
 
     # turn all saved metrics into a dataframe
     df = pd.DataFrame({
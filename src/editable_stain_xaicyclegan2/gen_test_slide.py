@@ -12,19 +12,22 @@ from vsiprocesssor.vsi_file import VSIFile
 from cv2 import imwrite, resize
 import torch
 
+from editable_stain_xaicyclegan2.setup.profiler_module import ProfilerModule
 from editable_stain_xaicyclegan2.setup.settings_module import Settings
 
 settings = Settings('settings.cfg')  # torch.load('models/Experiment X/final_model_checkpoint.pth')['settings'])
 
 generator = Generator(settings.generator_downconv_filters, settings.num_resnet_blocks)
-generator.load_state_dict(torch.load('models/Experiment X/final_model_checkpoint.pth')['generator_he_to_p63_state_dict'])
+checkpoint = torch.load('models/Experiment X/final_model_checkpoint.pth')
+# prefer the averaged generator weights, older checkpoints don't have them
+generator.load_state_dict(checkpoint.get('generator_he_to_p63_ema_state_dict', checkpoint['generator_he_to_p63_state_dict']))
 generator.eval()
 generator.to('cuda')
 
 tf = DefaultTransform()
 
 # This func converts all tiles in a VSI to a single image that's 1/4th size, and saves to disk for evaluation
-with torch.no_grad(), VSIFile('../data/raw/4_HE.vsi') as vsi:
+with torch.no_grad(), VSIFile('../data/raw/4_HE.vsi') as vsi, ProfilerModule(settings, 'gen_test_slide') as profiler:
     out_img = np.zeros((vsi.max_y_idx * vsi.target_size[0], vsi.max_x_idx * vsi.target_size[1], 3), dtype=np.uint8)
     # out_img = np.zeros((1000, 1000, 3), dtype=np.uint8)
     roi_y = vsi.target_size[0]
@@ -39,6 +42,7 @@ with torch.no_grad(), VSIFile('../data/raw/4_HE.vsi') as vsi:
         curr_x = (vsi.idx - 1) % vsi.max_x_idx
 
         out_img[curr_y * roi_y:(curr_y + 1) * roi_y, curr_x * roi_x:(curr_x + 1) * roi_x, :] = fake
+        profiler.step()
 
     # bgr to rgb
     out_img = out_img[:, :, ::-1]
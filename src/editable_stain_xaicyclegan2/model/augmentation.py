@@ -0,0 +1,142 @@
+"""
+    Prevzatý kód
+"""
+
+import kornia.color
+import torch
+
+from editable_stain_xaicyclegan2.model.dataset import LabNormalize
+
+# stain vectors of hematoxylin, eosin and DAB in optical density space, as in skimage.color.rgb_from_hed
+RGB_FROM_HED = torch.tensor([[0.65, 0.70, 0.29],
+                             [0.07, 0.99, 0.11],
+                             [0.27, 0.57, 0.78]])
+RGB_FROM_HED = RGB_FROM_HED / RGB_FROM_HED.norm(dim=1, keepdim=True)
+HED_FROM_RGB = torch.linalg.inv(RGB_FROM_HED)
+
+
+class BatchAugmentation:
+
+    def __init__(self, crop: int = None, flip_horizontal: bool = True, flip_vertical: bool = True,
+                 rot90: bool = True, color_jitter: float = 0.0, color_space: str = 'hed', seed: int = 0,
+                 device: torch.device = torch.device('cpu'), lab_normalize: LabNormalize = None):
+        """
+        Augments whole batches of normalized LAB images on the device, every sample with its own parameters drawn
+        from a dedicated generator. The random crop, flips and rotation by multiples of 90 degrees are combined into
+        a single gather, the optional color jitter scales and shifts the channels of every sample, either the stain
+        concentrations in HED space or the normalized LAB channels directly.
+
+        :param crop: size of the square random crop, None keeps the full image
+        :param flip_horizontal: flip the images horizontally with a 50% chance
+        :param flip_vertical: flip the images vertically with a 50% chance
+        :param rot90: rotate the images by a random multiple of 90 degrees
+        :param color_jitter: strength of the color jitter, scales are drawn from [1 - s, 1 + s], shifts from [-s, s]
+        :param color_space: 'hed' or 'lab', space of the color jitter
+        :param seed: seed of the generator
+        :param device: device of the batches and the generator
+        :param lab_normalize: normalization of the LAB channels of the batches, LabNormalize() by default
+        """
+
+        self.crop = crop
+        self.flip_horizontal = flip_horizontal
+        self.flip_vertical = flip_vertical
+        self.rot90 = rot90
+        self.color_jitter = color_jitter
+        self.color_space = color_space
+        self.device = device
+
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(seed)
+
+        lab_normalize = lab_normalize if lab_normalize is not None else LabNormalize()
+        self.lab_mean = torch.tensor([lab_normalize.l_mean, lab_normalize.ab_mean, lab_normalize.ab_mean],
+                                     device=device).view(1, 3, 1, 1)
+        self.lab_std = torch.tensor([lab_normalize.l_std, lab_normalize.ab_std, lab_normalize.ab_std],
+                                    device=device).view(1, 3, 1, 1)
+        self.rgb_from_hed = RGB_FROM_HED.to(device)
+        self.hed_from_rgb = HED_FROM_RGB.to(device)
+
+    def state_dict(self) -> dict:
+        return {'generator': self.generator.get_state()}
+
+    def load_state_dict(self, state_dict: dict):
+        self.generator.set_state(state_dict['generator'].cpu())
+
+    def _uniform(self, size: tuple, low: float, high: float) -> torch.Tensor:
+        return torch.rand(size, generator=self.generator, device=self.device) * (high - low) + low
+
+    def _randint(self, high: int, size: int) -> torch.Tensor:
+        return torch.randint(0, high, (size,), generator=self.generator, device=self.device)
+
+    # source index in the flattened image of every output pixel, for the crop offsets, flips and rotations
+    def get_indices(self, batch_size: int, height: int, width: int) -> tuple[torch.Tensor, int]:
+        size = min(self.crop or min(height, width), height, width)
+        y0 = self._randint(height - size + 1, batch_size).view(-1, 1, 1)
+        x0 = self._randint(width - size + 1, batch_size).view(-1, 1, 1)
+
+        last = size - 1
+        i = torch.arange(size, device=self.device).view(1, -1, 1).expand(batch_size, size, size)
+        j = torch.arange(size, device=self.device).view(1, 1, -1).expand(batch_size, size, size)
+
+        if self.rot90:
+            k = self._randint(4, batch_size).view(-1, 1, 1)
+            i, j = (torch.where(k == 0, i, torch.where(k == 1, j, torch.where(k == 2, last - i, last - j))),
+                    torch.where(k == 0, j, torch.where(k == 1, last - i, torch.where(k == 2, last - j, i))))
+
+        if self.flip_horizontal:
+            j = torch.where(self._randint(2, batch_size).view(-1, 1, 1).bool(), last - j, j)
+
+        if self.flip_vertical:
+            i = torch.where(self._randint(2, batch_size).view(-1, 1, 1).bool(), last - i, i)
+
+        return ((y0 + i) * width + x0 + j).view(batch_size, -1), size
+
+    def jitter_lab(self, images: torch.Tensor) -> torch.Tensor:
+        batch_size = images.size(0)
+        scale = self._uniform((batch_size, 3, 1, 1), 1 - self.color_jitter, 1 + self.color_jitter)
+        shift = self._uniform((batch_size, 3, 1, 1), -self.color_jitter, self.color_jitter)
+
+        # the a and b channels share their parameters, otherwise the hue would shift
+        scale[:, 2] = scale[:, 1]
+        shift[:, 2] = shift[:, 1]
+
+        return torch.addcmul(shift, images, scale)
+
+    def jitter_hed(self, images: torch.Tensor) -> torch.Tensor:
+        batch_size = images.size(0)
+        scale = self._uniform((batch_size, 1, 1, 3), 1 - self.color_jitter, 1 + self.color_jitter)
+        shift = self._uniform((batch_size, 1, 1, 3), -self.color_jitter, self.color_jitter)
+
+        rgb = kornia.color.lab_to_rgb(images * self.lab_std + self.lab_mean).clamp(1e-6, 1)
+        optical_density = -torch.log(rgb).permute(0, 2, 3, 1)
+        hed = torch.addcmul(shift, optical_density @ self.hed_from_rgb, scale)
+        rgb = torch.exp(-(hed @ self.rgb_from_hed)).clamp(0, 1).permute(0, 3, 1, 2)
+
+        return (kornia.color.rgb_to_lab(rgb) - self.lab_mean) / self.lab_std
+
+    @torch.no_grad()
+    def __call__(self, images: torch.Tensor, *paired: torch.Tensor):
+        """
+        :param images: normalized LAB batch of size (B, C, H, W)
+        :param paired: further batches of the same size, e.g. masks or the other stain of paired tiles, which get the
+         same crop, flips and rotation but no color jitter
+        :return: the augmented batch, or a tuple of all augmented batches if paired batches were given
+        """
+
+        batch_size, _, height, width = images.shape
+        indices, size = self.get_indices(batch_size, height, width)
+
+        def transform(batch):
+            gathered = batch.reshape(batch_size, batch.size(1), -1).gather(
+                2, indices.unsqueeze(1).expand(-1, batch.size(1), -1))
+            return gathered.view(batch_size, batch.size(1), size, size)
+
+        augmented = transform(images)
+
+        if self.color_jitter > 0:
+            augmented = self.jitter_hed(augmented) if self.color_space == 'hed' else self.jitter_lab(augmented)
+
+        if not paired:
+            return augmented
+
+        return (augmented,) + tuple(transform(batch) for batch in paired)
@@ -4,12 +4,56 @@
 
 from PIL import Image
 import kornia.color
+import io
+import json
+import numpy as np
+import tarfile
+import torch
+import torch.nn.functional as F
 import torch.utils.data as data
+from torchvision import io as tvio
 from torchvision import transforms
 import kornia
 import os
 import random
 
+# errors of a corrupt or truncated image, torchvision raises RuntimeError where PIL raises OSError
+DECODE_ERRORS = (OSError, SyntaxError, RuntimeError)
+
+
+# decodes an image file, or its encoded content, into RGB, a PIL image with the 'pil' backend,
+# with 'torchvision' directly into a (C, H, W) uint8 tensor without any intermediate copies
+def decode_image(source: str | bytes, backend: str = 'pil'):
+    if backend == 'torchvision':
+        encoded = tvio.read_file(source) if isinstance(source, str) else torch.frombuffer(bytearray(source),
+                                                                                          dtype=torch.uint8)
+        return tvio.decode_image(encoded, mode=tvio.ImageReadMode.RGB)
+
+    return Image.open(source if isinstance(source, str) else io.BytesIO(source)).convert('RGB')
+
+
+# bilinear resize of a PIL image or a uint8 tensor to size x size, images of that size are returned as they are
+def resize_image(img, size: int):
+    if isinstance(img, torch.Tensor):
+        if img.shape[-2:] == (size, size):
+            return img
+
+        img = F.interpolate(img.unsqueeze(0).float(), size=(size, size), mode='bilinear', antialias=True)
+        return img.squeeze(0).round_().clamp_(0, 255).to(torch.uint8)
+
+    if img.size == (size, size):
+        return img
+
+    return img.resize((size, size), Image.BILINEAR)
+
+
+# crop of a PIL image or a (C, H, W) tensor
+def crop_image(img, x: int, y: int, size: int):
+    if isinstance(img, torch.Tensor):
+        return img[:, y:y + size, x:x + size]
+
+    return img.crop((x, y, x + size, y + size))
+
 
 class LabNormalize:
     def __init__(self, l_mean: float = 50, l_std: float = 29.59, ab_mean: float = 0, ab_std: float = 74.04):
@@ -63,12 +107,348 @@ class DefaultTransform:
     def init(self):
 
         self.transform = transforms.Compose([
-            transforms.ToTensor(),
+            ToFloatTensor(),
             kornia.color.rgb_to_lab,
             LabNormalize(),
         ])
 
 
+class ToFloatTensor(transforms.ToTensor):
+    """
+    transforms.ToTensor which also takes the (C, H, W) uint8 tensors of the torchvision decode backend.
+    """
+
+    def __call__(self, pic):
+        if isinstance(pic, torch.Tensor):
+            return pic.float().div_(255)
+
+        return super().__call__(pic)
+
+
+class ToUint8Tensor:
+    """
+    Transform of the datasets when the LAB conversion runs on the device, see DeviceLabTransform.
+    Turns a PIL image or an (H, W, C) uint8 array into a (C, H, W) uint8 tensor, without any float math,
+    so the workers only decode and the batches are a quarter of the size of float batches.
+    Tensors of the torchvision decode backend already are.
+    """
+
+    def __call__(self, img):
+        if isinstance(img, torch.Tensor):
+            return img
+
+        if isinstance(img, Image.Image):
+            img = np.array(img, dtype=np.uint8)  # a writable copy, np.asarray of an image is read-only
+
+        return torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1)
+
+
+class DeviceLabTransform:
+
+    def __init__(self, lab_normalize: LabNormalize = None):
+        """
+        Batched counterpart of DefaultTransform for uint8 batches of ToUint8Tensor, applied on the device
+        after the transfer. The scaling to [0, 1] and the normalization of LabNormalize are folded into a single
+        multiply-add per side of the conversion, the result matches DefaultTransform.
+
+        :param lab_normalize: normalization of the LAB channels, LabNormalize() by default
+        """
+
+        lab_normalize = lab_normalize if lab_normalize is not None else LabNormalize()
+
+        std = torch.tensor([lab_normalize.l_std, lab_normalize.ab_std, lab_normalize.ab_std])
+        mean = torch.tensor([lab_normalize.l_mean, lab_normalize.ab_mean, lab_normalize.ab_mean])
+        self.scale = (1 / std).view(1, 3, 1, 1)
+        self.shift = (-mean / std).view(1, 3, 1, 1)
+        self.tensors = {}  # scale and shift per device
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        """
+        :param images: uint8 tensor of size (B, C, H, W) or (C, H, W), already normalized images are returned as is
+        :return: normalized LAB float tensor of the same size
+        """
+
+        if images.dtype != torch.uint8:
+            return images
+
+        if images.device not in self.tensors:
+            self.tensors[images.device] = (self.scale.to(images.device), self.shift.to(images.device))
+
+        scale, shift = self.tensors[images.device]
+        squeeze = images.dim() == 3
+        images = images.unsqueeze(0) if squeeze else images
+
+        lab = kornia.color.rgb_to_lab(images.float().div_(255))
+        lab = torch.addcmul(shift, lab, scale)
+
+        return lab.squeeze(0) if squeeze else lab
+
+
+class PairedDomainDataset(data.Dataset):
+
+    def __init__(self, he_data: data.Dataset, p63_data: data.Dataset):
+        """
+        Serves samples of both domains at once, indexed by a (he_index, p63_index) tuple,
+        so that a single DataLoader (and a single worker pool) feeds both domains.
+        The indices are returned with the samples, e.g. for LossAwareSampler.
+
+        :param he_data: dataset of the H&E domain
+        :param p63_data: dataset of the P63 domain
+        """
+
+        super(PairedDomainDataset, self).__init__()
+
+        self.he_data = he_data
+        self.p63_data = p63_data
+
+    def __getitem__(self, index):
+        he_index, p63_index = index
+        return self.he_data[he_index], self.p63_data[p63_index], he_index, p63_index
+
+    def __len__(self):
+        return max(len(self.he_data), len(self.p63_data))
+
+
+class PairedDomainSampler(data.Sampler):
+
+    def __init__(self, he_length: int, p63_length: int, shuffle: bool = True, seed: int = 0):
+        """
+        Infinite sampler of (he_index, p63_index) pairs. Each domain is drawn from its own stream of
+        permutations, so neither domain is truncated to the length of the other. The n-th permutation
+        of a domain depends only on the seed and n, so the stream can start at any position, which is
+        used to resume training without loading the already seen samples.
+
+        :param he_length: number of samples of the H&E domain
+        :param p63_length: number of samples of the P63 domain
+        :param shuffle: shuffle each pass over a domain
+        :param seed: base seed of the permutations
+        """
+
+        super(PairedDomainSampler, self).__init__()
+
+        self.lengths = (he_length, p63_length)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.position = 0
+
+    def set_position(self, position: int):
+        # takes effect for iterators created afterwards
+        self.position = position
+
+    def _stream(self, domain):
+        length = self.lengths[domain]
+        permutation, offset = divmod(self.position, length)
+
+        while True:
+            if self.shuffle:
+                generator = torch.Generator()
+                generator.manual_seed(self.seed + 2 * permutation + domain)
+                indices = torch.randperm(length, generator=generator).tolist()
+            else:
+                indices = list(range(length))
+
+            yield from indices[offset:]
+            permutation += 1
+            offset = 0
+
+    def __iter__(self):
+        return zip(self._stream(0), self._stream(1))
+
+
+class LossAwareSampler(data.Sampler):
+
+    def __init__(self, he_filenames: list[str], p63_filenames: list[str], floor: float = 0.2, momentum: float = 0.9,
+                 block_size: int = 256, seed: int = 0):
+        """
+        Infinite sampler of (he_index, p63_index) pairs, which draws the tiles of each domain with a probability
+        proportional to their running training loss, mixed with a uniform floor so that every tile keeps being
+        visited. Tiles that were not trained on yet get the mean loss of the domain. The losses are reported with
+        update() and kept by filename, so they survive a change in the order of the dataset between runs.
+
+        :param he_filenames: DatasetFromFolder.image_filenames of the H&E domain
+        :param p63_filenames: DatasetFromFolder.image_filenames of the P63 domain
+        :param floor: share of the probability mass spread uniformly over all tiles
+        :param momentum: weight of the previous running loss of a tile when a new loss is reported
+        :param block_size: number of indices drawn at once, the probabilities are updated between blocks
+        :param seed: seed of the sampling
+        """
+
+        super(LossAwareSampler, self).__init__()
+
+        self.filenames = (he_filenames, p63_filenames)
+        self.floor = floor
+        self.momentum = momentum
+        self.block_size = block_size
+        self.seed = seed
+        self.position = 0
+
+        self.losses = tuple(torch.full((len(filenames),), float('nan'), dtype=torch.float64)
+                            for filenames in self.filenames)
+
+    def set_position(self, position: int):
+        # the draws depend on the losses, so only the seed of the continued stream depends on the position
+        self.position = position
+
+    def update(self, domain: int, indices, losses):
+        """
+        :param domain: 0 for H&E, 1 for P63
+        :param indices: dataset indices of the tiles
+        :param losses: per-tile training losses
+        """
+
+        indices = torch.as_tensor(indices, dtype=torch.long).cpu()
+        losses = torch.as_tensor(losses, dtype=torch.float64).cpu()
+        running = self.losses[domain]
+
+        previous = running[indices]
+        running[indices] = torch.where(previous.isnan(), losses,
+                                       self.momentum * previous + (1 - self.momentum) * losses)
+
+    def probabilities(self, domain: int) -> torch.Tensor:
+        losses = self.losses[domain]
+        seen = ~losses.isnan()
+
+        if not seen.any():
+            return torch.full_like(losses, 1 / len(losses))
+
+        losses = torch.where(seen, losses, losses[seen].mean()).clamp_min(0)
+        total = losses.sum()
+        weights = losses / total if total > 0 else torch.full_like(losses, 1 / len(losses))
+
+        return (1 - self.floor) * weights + self.floor / len(losses)
+
+    def _stream(self, domain):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + 2 * self.position + domain)
+
+        while True:
+            yield from torch.multinomial(self.probabilities(domain), self.block_size, replacement=True,
+                                         generator=generator).tolist()
+
+    def __iter__(self):
+        return zip(self._stream(0), self._stream(1))
+
+    def state_dict(self) -> dict:
+        return {
+            'losses': [dict(zip(filenames, losses.tolist())) for filenames, losses in zip(self.filenames, self.losses)]
+        }
+
+    def load_state_dict(self, state_dict: dict):
+        for filenames, losses, saved in zip(self.filenames, self.losses, state_dict['losses']):
+            losses.copy_(torch.tensor([saved.get(filename, float('nan')) for filename in filenames]))
+
+
+class SharedTileCache:
+    # indices into counters
+    CLOCK, HITS, MISSES, EVICTIONS, STALE = range(5)
+
+    def __init__(self, num_tiles: int, tile_shape: tuple[int, int, int], capacity_bytes: int):
+        """
+        Pool of decoded uint8 (C, H, W) tiles in shared memory, filled lazily by whichever worker decodes a tile
+        first and read by all workers of all epochs without decoding or transferring it. When the byte budget is
+        exhausted the least recently used tile is evicted. The pool and its bookkeeping are shared tensors guarded
+        by one lock, a tile is written under the lock and read outside of it, every write bumps the version of the
+        slot, so that a read overlapping the eviction of its tile is detected by is_valid.
+
+        :param num_tiles: number of tiles of the dataset
+        :param tile_shape: shape of every tile, (C, H, W)
+        :param capacity_bytes: memory budget of the pool
+        """
+
+        tile_bytes = int(np.prod(tile_shape))
+        slots = min(capacity_bytes // tile_bytes, num_tiles)
+
+        if slots < 1:
+            raise ValueError(f"a tile cache of {capacity_bytes} bytes cannot hold a single tile of {tile_bytes} bytes")
+
+        self.tile_shape = tuple(tile_shape)
+        self.images = torch.zeros((slots, *tile_shape), dtype=torch.uint8).share_memory_()
+        self.slot_of_tile = torch.full((num_tiles,), -1, dtype=torch.int64).share_memory_()
+        self.tile_of_slot = torch.full((slots,), -1, dtype=torch.int64).share_memory_()
+        self.last_used = torch.full((slots,), -1, dtype=torch.int64).share_memory_()
+        self.versions = torch.zeros(slots, dtype=torch.int64).share_memory_()
+        self.counters = torch.zeros(5, dtype=torch.int64).share_memory_()
+        self.lock = torch.multiprocessing.Lock()
+
+    def _touch(self, slot: int):
+        self.counters[self.CLOCK] += 1
+        self.last_used[slot] = self.counters[self.CLOCK]
+
+    def read(self, index: int):
+        """
+        :return: a view of the cached tile in the pool and a token for is_valid, None if the tile is not cached
+        """
+
+        with self.lock:
+            slot = int(self.slot_of_tile[index])
+
+            if slot < 0:
+                self.counters[self.MISSES] += 1
+                return None
+
+            self.counters[self.HITS] += 1
+            self._touch(slot)
+            version = int(self.versions[slot])
+
+        return self.images[slot], (slot, version)
+
+    # whether the slot still held the same tile during the whole read
+    def is_valid(self, token: tuple[int, int]) -> bool:
+        slot, version = token
+
+        with self.lock:
+            valid = int(self.versions[slot]) == version
+
+            if not valid:
+                self.counters[self.STALE] += 1
+
+        return valid
+
+    # whether the tensor is a view of the pool, which must be copied before it leaves the dataset
+    def owns(self, img) -> bool:
+        return isinstance(img, torch.Tensor) and \
+            img.untyped_storage().data_ptr() == self.images.untyped_storage().data_ptr()
+
+    def put(self, index: int, img):
+        if not isinstance(img, torch.Tensor):
+            img = torch.from_numpy(np.array(img, dtype=np.uint8)).permute(2, 0, 1)
+
+        if tuple(img.shape) != self.tile_shape:
+            return
+
+        with self.lock:
+            if self.slot_of_tile[index] >= 0:  # cached by another worker meanwhile
+                return
+
+            slot = int(self.last_used.argmin())
+            evicted = int(self.tile_of_slot[slot])
+
+            if evicted >= 0:
+                self.slot_of_tile[evicted] = -1
+                self.counters[self.EVICTIONS] += 1
+
+            self.versions[slot] += 1
+            self.images[slot].copy_(img)
+            self.tile_of_slot[slot] = index
+            self.slot_of_tile[index] = slot
+            self._touch(slot)
+
+    def stats(self) -> dict[str, float]:
+        hits, misses = int(self.counters[self.HITS]), int(self.counters[self.MISSES])
+        cached = int((self.tile_of_slot >= 0).sum())
+
+        return {
+            'hit_rate': hits / max(hits + misses, 1),
+            'hits': hits,
+            'misses': misses,
+            'evictions': int(self.counters[self.EVICTIONS]),
+            'stale_reads': int(self.counters[self.STALE]),
+            'cached_tiles': cached,
+            'capacity_tiles': self.images.size(0),
+            'cached_mib': cached * self.images[0].numel() / 2 ** 20
+        }
+
+
 # Not my code, but I'm using it for the dataset
 class DatasetFromFolder(data.Dataset):
     def __init__(
@@ -80,7 +460,10 @@ class DatasetFromFolder(data.Dataset):
             resize: int = 256,
             crop_size: int = None,
             flip_h: bool = True,
-            flip_v: bool = True
+            flip_v: bool = True,
+            manifest: bool = False,
+            decode_backend: str = 'pil',
+            cache_bytes: int = None
     ):
 
         """
@@ -94,12 +477,24 @@ class DatasetFromFolder(data.Dataset):
         :param crop_size: crop the images to the size of width and height specified by this argument
         :param flip_h: flip the images horizontally with a 50% chance
         :param flip_v: flip the images vertically with a 50% chance
+        :param manifest: take the already validated tiles from the manifest written by build_manifest.py instead of
+         listing the folder, unreadable tiles are then skipped instead of deleted
+        :param decode_backend: 'pil' or 'torchvision', which decodes straight into uint8 tensors, see decode_image
+        :param cache_bytes: keep up to this many bytes of decoded and resized tiles in a SharedTileCache shared by all
+         workers, unreadable tiles are then skipped instead of deleted
         """
 
         super(DatasetFromFolder, self).__init__()
 
         self.input_path = os.path.join(image_dir, sub_folder)
-        self.image_filenames = [x for x in sorted(os.listdir(self.input_path))]
+        self.manifest = manifest
+        self.decode_backend = decode_backend
+
+        if manifest:
+            self.image_filenames = np.char.decode(load_manifest(image_dir, sub_folder)['filenames']).tolist()
+        else:
+            self.image_filenames = [x for x in sorted(os.listdir(self.input_path))]
+
         self.seq = 0
         self.seq2 = 0
         self.resize = resize
@@ -107,35 +502,48 @@ class DatasetFromFolder(data.Dataset):
         self.flip_h = flip_h
         self.flip_v = flip_v
 
-        if transform is None:
-            self.transform = DefaultTransform(transform_norm_dict)
+        self.transform = transform if transform is not None else DefaultTransform(transform_norm_dict)
+
+        # created before the workers are started, so that all of them share it
+        self.cache = None
+
+        if cache_bytes:
+            if not resize:
+                raise ValueError("the tile cache needs a fixed tile size, resize must be set")
+
+            self.cache = SharedTileCache(len(self.image_filenames), (3, resize, resize), cache_bytes)
 
     def __getitem__(self, index):
+        if self.cache is not None:
+            cached = self.cache.read(index)
 
-        while True:
-            try:
-                img_fn = os.path.join(self.input_path, self.image_filenames[index])
-                img = Image.open(img_fn).convert('RGB')
-            except (OSError, SyntaxError) as e:
-                print(e)
-                print("Deleting it.")
-                os.remove(img_fn)
-                self.image_filenames.pop(index)
-                continue
-            except IndexError:
-                # change index to random one
-                index = random.randint(0, len(self.image_filenames) - 1)
-            else:
-                break
+            # the tile is transformed straight from the shared pool, unless it was evicted meanwhile
+            if cached is not None:
+                img, token = cached
+                img = self._preprocess(img)
+
+                if self.cache.owns(img):
+                    img = img.clone()
+
+                if self.cache.is_valid(token):
+                    return img
+
+        img, index = self._load_image(index)
 
-        # preprocessing
         if self.resize:
-            img = img.resize((self.resize, self.resize), Image.BILINEAR)
+            img = resize_image(img, self.resize)
+
+        if self.cache is not None:
+            self.cache.put(index, img)
 
+        return self._preprocess(img)
+
+    # preprocessing of a resized tile
+    def _preprocess(self, img):
         if self.crop_size:
             x = random.randint(0, self.resize - self.crop_size + 1)
             y = random.randint(0, self.resize - self.crop_size + 1)
-            img = img.crop((x, y, x + self.crop_size, y + self.crop_size))
+            img = crop_image(img, x, y, self.crop_size)
 
         # flipping switched off in order to keep parity orientation (may have impact on image quality)
         """ 
@@ -153,6 +561,30 @@ class DatasetFromFolder(data.Dataset):
 
         return img
 
+    def _load_image(self, index):
+        while True:
+            try:
+                img_fn = os.path.join(self.input_path, self.image_filenames[index])
+                img = decode_image(img_fn, self.decode_backend)
+            except DECODE_ERRORS as e:
+                print(e)
+
+                # the filenames of a manifest or a cache are shared by all workers and must not diverge,
+                # the tile is only skipped
+                if self.manifest or self.cache is not None:
+                    index = random.randint(0, len(self.image_filenames) - 1)
+                    continue
+
+                print("Deleting it.")
+                os.remove(img_fn)
+                self.image_filenames.pop(index)
+                continue
+            except IndexError:
+                # change index to random one
+                index = random.randint(0, len(self.image_filenames) - 1)
+            else:
+                return img, index
+
     def __len__(self):
         return len(self.image_filenames)
 
@@ -174,33 +606,292 @@ class DatasetFromFolder(data.Dataset):
         return img
 
     def __getpic__(self, index):
-
-        while True:
-            try:
-                img_fn = os.path.join(self.input_path, self.image_filenames[index])
-                img = Image.open(img_fn).convert('RGB')
-            except (OSError, SyntaxError) as e:
-                print(e)
-                print("Deleting it.")
-                os.remove(img_fn)
-                self.image_filenames.pop(index)
-                continue
-            except IndexError:
-                # change index to random one
-                index = random.randint(0, len(self.image_filenames) - 1)
-            else:
-                break
+        img, _ = self._load_image(index)
 
         # preprocessing
         if self.resize:
-            img = img.resize((self.resize, self.resize), Image.BILINEAR)
+            img = resize_image(img, self.resize)
 
         if self.crop_size:
             x = random.randint(0, self.resize - self.crop_size + 1)
             y = random.randint(0, self.resize - self.crop_size + 1)
-            img = img.crop((x, y, x + self.crop_size, y + self.crop_size))
+            img = crop_image(img, x, y, self.crop_size)
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        return img
+
+
+# path of the manifest written by build_manifest.py for a tile folder, <folder>.manifest.npz next to it
+def get_manifest_path(image_dir: str, sub_folder: str) -> str:
+    return os.path.join(image_dir, os.path.normpath(sub_folder)) + ".manifest.npz"
+
+
+# the arrays of a manifest, the utf-8 encoded filenames of the valid tiles in sorted order and per tile the file size, crc32 checksum,
+# width, height, slide (index into 'slides') and x, y coordinates parsed from {vsi}_{x}_{y}.png, -1 if not parsable
+def load_manifest(image_dir: str, sub_folder: str) -> dict[str, np.ndarray]:
+    with np.load(get_manifest_path(image_dir, sub_folder), allow_pickle=False) as manifest:
+        return dict(manifest)
+
+
+# paths of the tile store written by pack_tiles.py for a tile folder, <folder>.npy and <folder>.json next to it
+def get_tile_store_paths(image_dir: str, sub_folder: str) -> tuple[str, str]:
+    base = os.path.join(image_dir, os.path.normpath(sub_folder))
+    return f"{base}.npy", f"{base}.json"
+
+
+class TileStoreDataset(data.Dataset):
+    def __init__(
+            self,
+            image_dir: str,
+            sub_folder: str,
+            transform_norm_dict: dict = None,
+            transform: DefaultTransform = None
+    ):
+
+        """
+        Dataset backed by a tile store written by pack_tiles.py, a single uint8 array of shape (N, H, W, C)
+        holding the already decoded and resized tiles of a folder. The array is memory-mapped, so a sample
+        is a slice of the page cache shared by all workers and nothing is decoded while training.
+
+        :param image_dir: path to the folder containing the tile stores
+        :param sub_folder: tile folder the store was packed from, e.g. 'train/p63'
+        :param transform_norm_dict: dictionary with mean and std values for normalization
+        :param transform: transform to apply to the images
+        """
+
+        super(TileStoreDataset, self).__init__()
+
+        self.store_path, index_path = get_tile_store_paths(image_dir, sub_folder)
+
+        with open(index_path, 'r') as file:
+            index = json.load(file)
+
+        self.image_filenames = index['filenames']
+        self.size = index['size']
+        self.images = None  # opened on first use in every worker, see __getstate__
+        self.transform = transform if transform is not None else DefaultTransform(transform_norm_dict)
+
+    def _open(self):
+        # copy-on-write, the tiles can be handed out without copying and the store is never modified
+        self.images = np.load(self.store_path, mmap_mode='c')
+
+    def __getitem__(self, index):
+        if self.images is None:
+            self._open()
+
+        img = self.images[index]
 
         if self.transform is not None:
             img = self.transform(img)
 
         return img
+
+    def __len__(self):
+        return len(self.image_filenames)
+
+    def __getstate__(self):
+        # the memory map is not sent to the workers, it would be pickled as a copy of the whole array
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+    def get_random_image(self):
+        return self.__getitem__(random.randint(0, len(self.image_filenames) - 1))
+
+
+# directory of the tar shards written by shard_tiles.py for a tile folder, <folder>.shards next to it
+def get_shard_dir(image_dir: str, sub_folder: str) -> str:
+    return os.path.join(image_dir, os.path.normpath(sub_folder)) + ".shards"
+
+
+# rank and number of ranks of the process group, 0 and 1 when not training distributed
+def get_rank_and_world_size() -> tuple[int, int]:
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+
+    return 0, 1
+
+
+class ShardDataset(data.IterableDataset):
+    def __init__(
+            self,
+            image_dir: str,
+            sub_folder: str,
+            transform_norm_dict: dict = None,
+            transform: DefaultTransform = None,
+            resize: int = 256,
+            shuffle: bool = True,
+            buffer_size: int = 1000,
+            seed: int = 0,
+            infinite: bool = True,
+            decode_backend: str = 'pil'
+    ):
+
+        """
+        Streams the tiles of a folder from the tar shards written by shard_tiles.py, each shard is read
+        sequentially from start to end. Every pass the shards are shuffled with the same seed in every worker and
+        rank and then dealt out to them, so each tile is read once per pass. If there are fewer shards than
+        workers times ranks, every consumer reads all shards and keeps every n-th tile. The tiles are additionally
+        shuffled within a buffer of buffer_size tiles, which holds the still encoded pngs.
+        Yields (image, index) with the index of the tile in image_filenames.
+
+        :param image_dir: path to the folder containing the tile folders
+        :param sub_folder: tile folder the shards were packed from, e.g. 'train/p63'
+        :param transform_norm_dict: dictionary with mean and std values for normalization
+        :param transform: transform to apply to the images
+        :param resize: resize the images to the size of width and height specified by this argument
+        :param shuffle: shuffle the shards of each pass and the tiles within the buffer
+        :param buffer_size: number of tiles the in-shard shuffle draws from
+        :param seed: base seed of the shard order and the buffer
+        :param infinite: start the next pass after the last shard instead of stopping
+        :param decode_backend: 'pil' or 'torchvision', see decode_image
+        """
+
+        super(ShardDataset, self).__init__()
+
+        self.shard_dir = get_shard_dir(image_dir, sub_folder)
+
+        with open(os.path.join(self.shard_dir, 'index.json'), 'r') as file:
+            index = json.load(file)
+
+        self.image_filenames = index['filenames']
+        self.shards = [shard['name'] for shard in index['shards']]
+        self.resize = resize
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size if shuffle else 0
+        self.seed = seed
+        self.infinite = infinite
+        self.decode_backend = decode_backend
+        self.epoch = 0
+        self.indices = None  # index of each filename, built in every worker on first use
+
+        self.transform = transform if transform is not None else DefaultTransform(transform_norm_dict)
+
+    def set_position(self, position: int):
+        # only the pass is restored, the order within a pass depends on the workers and is not reproducible
+        self.epoch = position // len(self.image_filenames)
+
+    def get_consumer(self) -> tuple[int, int]:
+        # index and number of all workers of all ranks reading the shards
+        rank, world_size = get_rank_and_world_size()
+        worker_info = data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        return rank * num_workers + worker_id, world_size * num_workers
+
+    def _read_pass(self, epoch: int, consumer: int, consumers: int):
+        order = list(range(len(self.shards)))
+
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + epoch)
+            order = torch.randperm(len(self.shards), generator=generator).tolist()
+
+        if len(order) >= consumers:
+            order, keep, stride = order[consumer::consumers], 0, 1
+        else:
+            keep, stride = consumer, consumers
+
+        position = 0
+        indices = self.indices
+
+        for shard in order:
+            with tarfile.open(os.path.join(self.shard_dir, self.shards[shard]), mode='r|') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+
+                    if position % stride == keep:
+                        yield indices[member.name], tar.extractfile(member).read()
+
+                    position += 1
+
+    def _decode(self, content: bytes):
+        img = decode_image(content, self.decode_backend)
+
+        if self.resize:
+            img = resize_image(img, self.resize)
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        return img
+
+    def _stream(self):
+        consumer, consumers = self.get_consumer()
+        rng = random.Random(hash((self.seed, self.epoch, consumer)))
+        buffer = []
+        epoch = self.epoch
+
+        while True:
+            for sample in self._read_pass(epoch, consumer, consumers):
+                if len(buffer) < self.buffer_size:
+                    buffer.append(sample)
+                    continue
+
+                if self.buffer_size:
+                    i = rng.randrange(self.buffer_size)
+                    buffer[i], sample = sample, buffer[i]
+
+                yield sample
+
+            epoch += 1
+
+            if not self.infinite:
+                break
+
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        if self.indices is None:
+            self.indices = {filename: i for i, filename in enumerate(self.image_filenames)}
+
+        for index, content in self._stream():
+            try:
+                img = self._decode(content)
+            except DECODE_ERRORS as e:
+                print(f"{self.image_filenames[index]}: {e}")
+                continue
+
+            yield img, index
+
+    def __len__(self):
+        return len(self.image_filenames)
+
+
+class PairedShardDataset(data.IterableDataset):
+
+    def __init__(self, he_data: ShardDataset, p63_data: ShardDataset, seed: int = 0):
+        """
+        Streaming counterpart of PairedDomainDataset and PairedDomainSampler, yields the same
+        (he_img, p63_img, he_index, p63_index) samples from two ShardDatasets, so it can replace both in the
+        training DataLoader. Both domains are infinite, so neither is truncated to the length of the other.
+
+        :param he_data: shards of the H&E domain
+        :param p63_data: shards of the P63 domain
+        :param seed: base seed of both domains
+        """
+
+        super(PairedShardDataset, self).__init__()
+
+        self.he_data = he_data
+        self.p63_data = p63_data
+        self.seed = seed
+
+    def set_position(self, position: int):
+        # takes effect for iterators created afterwards
+        self.he_data.set_position(position)
+        self.p63_data.set_position(position)
+
+    def __iter__(self):
+        self.he_data.seed = 2 * self.seed
+        self.p63_data.seed = 2 * self.seed + 1
+
+        for (he_img, he_index), (p63_img, p63_index) in zip(self.he_data, self.p63_data):
+            yield he_img, p63_img, he_index, p63_index
+
+    def __len__(self):
+        return max(len(self.he_data), len(self.p63_data))
@@ -80,6 +80,12 @@ class ExplanationController:
         self.explain_map /= 2
         return self.explain_map
 
+    # drop the explanations of the previous batches, e.g. when the size of the images changes
+    def reset(self):
+        self.explanation = ones(2, 3, 128, 128)
+        self.explanation_mask = ones(2, 3, 128, 128)
+        self.explain_map = None
+
     def set_losses(self, loss_disc, loss_disc_m):
         self.discriminator_loss = loss_disc.detach()
         self.discriminator_mask_loss = loss_disc_m.detach()
@@ -15,22 +15,61 @@ from functools import partial
 
 # obtain a noise mask with given mean and std
 def get_mask_noise(image, mean=1.0, std=0.02):  # A simple noise mask, with mean and std as parameters
-    return torch.normal(torch.full(image.shape, mean), std).cuda()
+    return torch.normal(torch.full(image.shape, mean, device=image.device), std)
+
+
+# obtain a flat disk footprint of given radius as a float kernel, equivalent to skimage.morphology.disk
+def get_disk_kernel(radius, device=None, dtype=torch.float32):
+    coords = torch.arange(-radius, radius + 1, device=device, dtype=dtype)
+    return ((coords[None, :] ** 2 + coords[:, None] ** 2) <= radius ** 2).to(dtype)
+
+
+# compute local entropy (in bits) of a batch of grayscale images, shape (B, 1, H, W), on their own device
+def get_local_entropy(image, disk_size=9, bins=32):
+    """
+    Batched replacement for skimage.filters.rank.entropy. Each image is quantized into the given number of
+    bins, turned into a one-hot histogram volume and convolved with a disk footprint, which yields the local
+    histogram of every pixel neighbourhood in a single grouped convolution.
+    :param image: Grayscale images of shape (B, 1, H, W).
+    :param disk_size: Radius of the disk footprint.
+    :param bins: Number of quantization levels for the local histograms.
+    :return: Local entropy of shape (B, 1, H, W).
+    """
+    image = image.detach().float()
+
+    # per-sample quantization into [0, bins - 1]
+    flat = image.flatten(1)
+    low = flat.min(dim=1)[0].view(-1, 1, 1, 1)
+    high = flat.max(dim=1)[0].view(-1, 1, 1, 1)
+    levels = ((image - low) / (high - low).clamp_min(1e-8) * (bins - 1)).round().long()
+
+    one_hot = torch.zeros(image.size(0), bins, *image.shape[2:], device=image.device)
+    one_hot.scatter_(1, levels, 1.0)
+
+    kernel = get_disk_kernel(disk_size, device=image.device)
+    weight = kernel.expand(bins, 1, -1, -1)
+
+    # zero padding, normalizing by the number of in-image pixels reproduces the border handling of skimage
+    counts = torch.nn.functional.conv2d(one_hot, weight, padding=disk_size, groups=bins)
+    total = torch.nn.functional.conv2d(torch.ones_like(image), kernel[None, None], padding=disk_size)
+
+    probabilities = counts / total.clamp_min(1)
+    return -(probabilities * torch.log2(probabilities.clamp_min(1e-12))).sum(dim=1, keepdim=True)
 
 
 # obtain a entropy mask with given disk size
-def get_mask_entropy(image, disk_size=9):  # A simple entropy mask, with disk size as parameter
-    # check if image is tensor, if yes convert to numpy, else leave as is
+def get_mask_entropy(image, disk_size=9, bins=32):  # A simple entropy mask, with disk size as parameter
+    # check if image is tensor, if yes compute the mask batched on its device, else use skimage
     if type(image) is torch.Tensor:
-        mask = np.zeros_like(image)
-        image = tf.rgb_to_grayscale(image)
-        image = image.detach().cpu().numpy().astype(np.uint8)
+        mask = get_local_entropy(tf.rgb_to_grayscale(image), disk_size, bins)
 
-        for i in range(image.shape[0]):
-            mask[i] = np.repeat(np.expand_dims(entropy(np.squeeze(image[i]), disk(disk_size)), 0), 3, axis=0)
+        # per-sample normalization to [-1, 1]
+        flat = mask.flatten(1)
+        low = flat.min(dim=1)[0].view(-1, 1, 1, 1)
+        high = flat.max(dim=1)[0].view(-1, 1, 1, 1)
+        mask = (((mask - low) / (high - low).clamp_min(1e-8)) - 0.5) * 2
 
-        mask = (((mask - np.min(mask)) / (np.max(mask) - np.min(mask))) - 0.5) * 2
-        return torch.tensor(mask, dtype=torch.float32)
+        return mask.expand(-1, image.size(1), -1, -1).contiguous()
 
     elif type(image) is np.ndarray:
         image = np.moveaxis(image, 2, 0)
@@ -63,6 +102,10 @@ def get_mask_rec_binary(image, ratio=0.9):  # A simple rectangular binary mask,
 
     binary_rec_mask[:, left_bound_y:up_bound_y, left_bound_x:up_bound_x] = 1
 
+    if type(image) is torch.Tensor:  # the same mask for every image of the batch
+        mask = torch.tensor(binary_rec_mask, dtype=torch.float32, device=image.device)
+        return mask.unsqueeze(0).expand(image.shape[0], -1, -1, -1).contiguous()
+
     return torch.tensor(binary_rec_mask, dtype=torch.float32)
 
 
@@ -4,6 +4,7 @@
 
 import torch
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import kornia
 from typing import Tuple, Union
 
@@ -180,9 +181,14 @@ class ResnetBlock(torch.nn.Module):
 
 
 class Generator(torch.nn.Module):
-    def __init__(self, num_filter, num_resnet, input_dim=3, output_dim=3):
+    def __init__(self, num_filter, num_resnet, input_dim=3, output_dim=3,
+                 checkpoint_resnet=False, checkpoint_decoder=False):
         super(Generator, self).__init__()
 
+        # Activation checkpointing, trades recomputation in the backward pass for activation memory
+        self.checkpoint_resnet = checkpoint_resnet
+        self.checkpoint_decoder = checkpoint_decoder
+
         # Mask encoder
         self.conv1dc = ConvBlock(input_dim * 2, input_dim, kernel_size=1, stride=1, padding=0, activation='no_act', batch_norm=False)
         self.conv1dm = ConvBlock(input_dim * 2, input_dim, kernel_size=1, stride=1, padding=0, activation='no_act', batch_norm=False)
@@ -246,6 +252,7 @@ class Generator(torch.nn.Module):
             imgx = self.interpretable_conv_1(imgx)
             imgx = self.interpretable_conv_2(imgx)
         else:
+            inv_masked_img = None
             imgx = self.interpretable_conv_2(self.interpretable_conv_1(img))
 
         enc1 = self.conv1(self.pad(imgx))  # (bs, num_filter, 128, 128)
@@ -254,12 +261,29 @@ class Generator(torch.nn.Module):
         self.enc4 = self.conv4(enc3)  # (bs, num_filter * 8, 16, 16)
 
         # Resnet blocks
-        res = self.resnet_blocks(self.enc4)
+        checkpointing = self.training and torch.is_grad_enabled()
+
+        if checkpointing and self.checkpoint_resnet:
+            res = self.enc4
+            for block in self.resnet_blocks:
+                res = torch.utils.checkpoint.checkpoint(block, res, use_reentrant=False)
+        else:
+            res = self.resnet_blocks(self.enc4)
+
         self.res_out = res
 
-        # Decoder
+        # Decoder, the attention blocks stay outside the checkpoints, recomputing them would advance the power
+        # iteration of their spectral norm a second time and use different weights in the backward pass
+        if checkpointing and self.checkpoint_decoder:
+            dec1 = torch.utils.checkpoint.checkpoint(self.deconv1, self.attention1(self.enc4, res), use_reentrant=False)
+            return torch.utils.checkpoint.checkpoint(self.decode, img, inv_masked_img, enc1, enc2,
+                                                     self.attention2(dec1, enc3), use_reentrant=False)
+
         dec1 = self.deconv1(self.attention1(self.enc4, res))
-        dec2 = self.deconv2(self.attention2(dec1, enc3))
+        return self.decode(img, inv_masked_img, enc1, enc2, self.attention2(dec1, enc3))
+
+    def decode(self, img, inv_masked_img, enc1, enc2, att2):
+        dec2 = self.deconv2(att2)
         dec3 = self.deconv3(dec2 + enc2)
         dec4 = self.deconv4(self.pad(dec3 + enc1))
         out = self.correction(self.pad1(dec4))
@@ -267,8 +291,7 @@ class Generator(torch.nn.Module):
 
         out = self.tanh_corr(out)
 
-        if mask is not None:
-            # noinspection PyUnboundLocalVariable
+        if inv_masked_img is not None:
             out = out + inv_masked_img
 
         out = self.guided_blur(out, img)
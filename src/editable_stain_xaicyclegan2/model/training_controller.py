@@ -3,37 +3,56 @@
 """
 
 import itertools
+import random
 from typing import Callable, Union
 
+import numpy as np
 import torch
 from torch.autograd import Variable
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset
+from torchmetrics.functional.image import peak_signal_noise_ratio as psnr
+from torchmetrics.functional.image import structural_similarity_index_measure as ssim
 
-# from torchmetrics.functional.image.ssim import structural_similarity_index_measure as ssim
-
-from editable_stain_xaicyclegan2.model.dataset import DatasetFromFolder
+from editable_stain_xaicyclegan2.model.augmentation import BatchAugmentation
+from editable_stain_xaicyclegan2.model.dataset import DatasetFromFolder, DeviceLabTransform, LossAwareSampler, \
+    PairedDomainDataset, PairedDomainSampler, PairedShardDataset, ShardDataset, TileStoreDataset, ToUint8Tensor
 from editable_stain_xaicyclegan2.model.explanation import ExplanationController
 from editable_stain_xaicyclegan2.model.mask import get_mask
 from editable_stain_xaicyclegan2.model.model import Generator, Discriminator
-from editable_stain_xaicyclegan2.model.utils import LambdaLR, ImagePool
+from editable_stain_xaicyclegan2.model.utils import LambdaLR, ImagePool, ModelEMA
 
+from editable_stain_xaicyclegan2.setup.logging_utils import PhaseTimer, denormalize_images
 from editable_stain_xaicyclegan2.setup.settings_module import Settings
 from editable_stain_xaicyclegan2.setup.wandb_module import WandbModule
 
 L_RANGE = 1.68976005407
 
+# generator passes per micro-batch: 4 for the translations and cycles, 2 for the adversarial loss and 2 for identity
+GENERATOR_PASSES = 8
+
 TensorType = Union[Variable, torch.Tensor]
 
 
 class TrainingController:
 
-    def __init__(self, settings: Settings | None, wandb_module: WandbModule | None, saved_model_obj: dict = None):
+    def __init__(self, settings: Settings | None, wandb_module: WandbModule | None, saved_model_obj: dict = None,
+                 resume: bool = False, load_data: bool = True):
+        """
+        :param settings: training settings, None takes them from saved_model_obj
+        :param wandb_module: wandb module used for logging, can be None for inference
+        :param saved_model_obj: checkpoint to load the model weights from
+        :param resume: also restore optimizers, schedulers, image pools, RNG states and the data position from
+         saved_model_obj and keep the models in training mode, instead of preparing them for inference
+        :param load_data: create the data loaders, can be disabled when the batches are supplied directly,
+         e.g. when benchmarking on synthetic data
+        """
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.half_precision = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
-        self.settings = settings
+        self.settings = settings if settings is not None else saved_model_obj['settings']
         self.wandb_module = wandb_module
 
         self.latest_generator_loss = None
+        self.latest_scheduled_generator_loss = None
         self.latest_discriminator_he_loss = None
         self.latest_discriminator_p63_loss = None
         self.latest_identity_loss = None
@@ -44,40 +63,136 @@ class TrainingController:
         if saved_model_obj:
             settings = saved_model_obj['settings']
 
-        # region Initialize data loaders
-        self.train_he_data = DatasetFromFolder(settings.data_root, settings.data_train_he, settings.norm_dict)
-        self.train_he = DataLoader(dataset=self.train_he_data, batch_size=settings.batch_size,
-                                   shuffle=True, pin_memory=True, num_workers=4)
-
-        # train data can be shuffled in order to get better results
-
-        self.train_p63_data = DatasetFromFolder(settings.data_root, settings.data_train_p63, settings.norm_dict)
-        self.train_p63 = DataLoader(dataset=self.train_p63_data, batch_size=settings.batch_size,
-                                    shuffle=True, pin_memory=True, num_workers=4)
-
-        self.test_he_data = DatasetFromFolder(settings.data_root, settings.data_test_he, settings.norm_dict)
-        self.test_he = DataLoader(dataset=self.test_he_data, batch_size=settings.batch_size,
-                                  shuffle=False, pin_memory=True, num_workers=4)
-
-        self.test_p63_data = DatasetFromFolder(settings.data_root, settings.data_test_p63, settings.norm_dict)
-        self.test_p63 = DataLoader(dataset=self.test_p63_data, batch_size=settings.batch_size,
-                                   shuffle=False, pin_memory=True, num_workers=4)
-
-        self.paired_he_data = DatasetFromFolder(settings.data_root, "paired_he", None)
-        self.paired_he = DataLoader(dataset=self.paired_he_data, batch_size=settings.batch_size,
-                                    shuffle=False, pin_memory=True, num_workers=4)
+        # per-phase timing of the training step, synchronizes cuda only when enabled
+        self.timer = PhaseTimer(self.settings.time_phases, self.settings.log_frequency, self.device.type == 'cuda')
 
-        self.paired_ihc_data = DatasetFromFolder(settings.data_root, "paired_ihc", None)
-        self.paired_ihc = DataLoader(dataset=self.paired_ihc_data, batch_size=settings.batch_size,
-                                     shuffle=False, pin_memory=True, num_workers=4)
+        # region Initialize data loaders
+        self.sampler_seed = random.randint(0, 2 ** 31 - 1)
+        self.steps_per_epoch = self.settings.steps_per_epoch
+
+        # the loaders can ship uint8 images which are converted to normalized LAB on the device in batches
+        self.data_transform = ToUint8Tensor() if self.settings.device_transform else None
+        self.device_transform = DeviceLabTransform()
+
+        # crop, flips, rotations and color jitter of the training batches, applied on the device in get_dummies
+        self.augmentation = BatchAugmentation(self.settings.crop, self.settings.flip_horizontal,
+                                              self.settings.flip_vertical, self.settings.augment_rot90,
+                                              self.settings.augment_color_jitter, self.settings.augment_color_space,
+                                              seed=self.sampler_seed, device=self.device) \
+            if self.settings.augment else None
+
+        if load_data:
+            # train data can be shuffled in order to get better results
+            self.train_he_data = self.get_train_dataset(settings, settings.data_train_he)
+            self.train_p63_data = self.get_train_dataset(settings, settings.data_train_p63)
+
+            # both domains come from a single loader with one persistent worker pool, the sampler is infinite and
+            # resumable, an epoch is defined as steps_per_epoch steps, by default one pass over the larger domain
+            self.steps_per_epoch = self.settings.steps_per_epoch or \
+                max(len(self.train_he_data), len(self.train_p63_data)) // self.settings.batch_size
+
+            self.train_data = PairedDomainDataset(self.train_he_data, self.train_p63_data)
+
+            # shards are streamed, the paired stream replaces both the dataset and the sampler
+            if self.settings.data_backend == 'shards':
+                if self.settings.sampling == 'loss':
+                    raise ValueError("sampling='loss' needs random access to the tiles, it is not available "
+                                     "with data_backend='shards'")
+
+                self.train_data = self.train_sampler = PairedShardDataset(self.train_he_data, self.train_p63_data,
+                                                                          seed=self.sampler_seed)
+            # tiles can also be drawn proportionally to their running cycle and identity loss
+            elif self.settings.sampling == 'loss':
+                self.train_sampler = LossAwareSampler(self.train_he_data.image_filenames,
+                                                      self.train_p63_data.image_filenames,
+                                                      floor=self.settings.sampling_floor,
+                                                      momentum=self.settings.sampling_momentum,
+                                                      seed=self.sampler_seed)
+            else:
+                self.train_sampler = PairedDomainSampler(len(self.train_he_data), len(self.train_p63_data),
+                                                         seed=self.sampler_seed)
+            self.train = DataLoader(dataset=self.train_data, batch_size=self.settings.batch_size,
+                                    sampler=self.train_sampler if self.train_sampler is not self.train_data else None,
+                                    pin_memory=True,
+                                    num_workers=self.settings.num_workers,
+                                    persistent_workers=self.settings.num_workers > 0,
+                                    prefetch_factor=self.settings.prefetch_factor
+                                    if self.settings.num_workers > 0 else None)
+
+            self.test_he_data = DatasetFromFolder(settings.data_root, settings.data_test_he, settings.norm_dict,
+                                                  self.data_transform, manifest=self.settings.data_manifest,
+                                                  decode_backend=self.settings.decode_backend)
+            self.test_he = DataLoader(dataset=self.test_he_data, batch_size=settings.batch_size,
+                                      shuffle=False, pin_memory=True, num_workers=4)
+
+            self.test_p63_data = DatasetFromFolder(settings.data_root, settings.data_test_p63, settings.norm_dict,
+                                                   self.data_transform, manifest=self.settings.data_manifest,
+                                                   decode_backend=self.settings.decode_backend)
+            self.test_p63 = DataLoader(dataset=self.test_p63_data, batch_size=settings.batch_size,
+                                       shuffle=False, pin_memory=True, num_workers=4)
+
+            self.paired_he_data = DatasetFromFolder(settings.data_root, "paired_he", None, self.data_transform,
+                                                    decode_backend=self.settings.decode_backend)
+            self.paired_he = DataLoader(dataset=self.paired_he_data, batch_size=settings.batch_size,
+                                        shuffle=False, pin_memory=True, num_workers=4)
+
+            self.paired_ihc_data = DatasetFromFolder(settings.data_root, "paired_ihc", None, self.data_transform,
+                                                     decode_backend=self.settings.decode_backend)
+            self.paired_ihc = DataLoader(dataset=self.paired_ihc_data, batch_size=settings.batch_size,
+                                         shuffle=False, pin_memory=True, num_workers=4)
+
+        # progressive resolution, random crops of progressive_sizes[i] are used until step progressive_milestones[i]
+        self.progressive_sizes = self.settings.progressive_sizes or []
+        self.progressive_milestones = self.settings.progressive_milestones or []
+
+        if len(self.progressive_sizes) != len(self.progressive_milestones):
+            raise ValueError("progressive_sizes and progressive_milestones must have the same length")
+
+        self.global_step = 0
+        self.training_size = self.get_training_size(0)
+        self.track_tile_losses = load_data and self.settings.sampling == 'loss'
+        self.tile_losses = []
+
+        # auxiliary loss terms computed every k steps (int schedule) or with probability p (float schedule),
+        # scaled by k or 1 / p when computed so that the expected gradient stays the same
+        self.loss_schedules = {
+            'identity': self.settings.identity_loss_schedule,
+            'context': self.settings.context_loss_schedule,
+            'cycle_context': self.settings.cycle_context_loss_schedule
+        }
+
+        for name, schedule in self.loss_schedules.items():
+            if isinstance(schedule, int) and schedule < 1 or isinstance(schedule, float) and not 0 < schedule <= 1:
+                raise ValueError(f"{name}_loss_schedule must be an int >= 1 or a probability in (0, 1]")
+
+        self.loss_scales = {name: 1.0 for name in self.loss_schedules}
+        self.loss_term_counts = {name: 0 for name in self.loss_schedules}
+        self.loss_schedule_steps = 0
+        self.adversarial_scale = 1.0
+
+        # test images used for visualisation, loaded on first use
+        self.visualisation_he = None
+        self.visualisation_p63 = None
+        self.visualisation_index = 0
+
+        # fixed validation subset and its masks, loaded to the device on first use
+        self.validation_he = None
+        self.validation_p63 = None
+        self.validation_he_mask = None
+        self.validation_p63_mask = None
         # endregion
 
         # region Initialize models
         generator_params = (settings.generator_downconv_filters, settings.num_resnet_blocks, settings.channels, settings.channels)
         discriminator_params = (settings.discriminator_downconv_filters, settings.channels)
 
-        self.generator_he_to_p63 = Generator(*generator_params)
-        self.generator_p63_to_he = Generator(*generator_params)
+        checkpointing = {
+            'checkpoint_resnet': self.settings.checkpoint_resnet_blocks,
+            'checkpoint_decoder': self.settings.checkpoint_decoder
+        }
+
+        self.generator_he_to_p63 = Generator(*generator_params, **checkpointing)
+        self.generator_p63_to_he = Generator(*generator_params, **checkpointing)
         self.discriminator_he = Discriminator(*discriminator_params)
         self.discriminator_p63 = Discriminator(*discriminator_params)
         self.discriminator_he_mask = Discriminator(*discriminator_params)
@@ -91,6 +206,12 @@ class TrainingController:
             self.discriminator_he_mask.load_state_dict(saved_model_obj['discriminator_he_mask_state_dict'])
             self.discriminator_p63_mask.load_state_dict(saved_model_obj['discriminator_p63_mask_state_dict'])
 
+        # a checkpoint used for inference provides the averaged generator weights if it has them
+        if saved_model_obj and not resume and 'generator_he_to_p63_ema_state_dict' in saved_model_obj:
+            self.generator_he_to_p63.load_state_dict(saved_model_obj['generator_he_to_p63_ema_state_dict'])
+            self.generator_p63_to_he.load_state_dict(saved_model_obj['generator_p63_to_he_ema_state_dict'])
+
+        if saved_model_obj and not resume:
             self.generator_he_to_p63.eval()
             self.generator_p63_to_he.eval()
             self.discriminator_he.eval()
@@ -106,8 +227,19 @@ class TrainingController:
         self.discriminator_p63_mask.to(self.device).to(memory_format=torch.channels_last)  # noqa
         # endregion
 
+        # region Initialize generator EMA
+        # created before wandb watching and the explanation hooks are attached, so the copies don't carry them
+        self.generator_ema = None
+        self.generator_he_to_p63_ema = self.generator_he_to_p63
+        self.generator_p63_to_he_ema = self.generator_p63_to_he
+
+        if self.settings.ema_decay and (saved_model_obj is None or resume):
+            self.generator_ema = ModelEMA((self.generator_he_to_p63, self.generator_p63_to_he), self.settings.ema_decay)
+            self.generator_he_to_p63_ema, self.generator_p63_to_he_ema = self.generator_ema.ema_models
+        # endregion
+
         # region Initialize wandb model watching
-        if saved_model_obj is None:
+        if saved_model_obj is None or resume:
             if torch.multiprocessing.current_process().name == 'MainProcess':
                 self.wandb_module.run.watch(
                     (
@@ -151,7 +283,7 @@ class TrainingController:
         # endregion
 
         # region Initialize optimizers
-        if saved_model_obj is None:
+        if saved_model_obj is None or resume:
             discriminator_he_params = itertools.chain(
                 self.discriminator_he.parameters(),
                 self.discriminator_he_mask.parameters()
@@ -191,12 +323,194 @@ class TrainingController:
         # endregion
 
         # region Initialize image pool
-        if saved_model_obj is None:
+        if saved_model_obj is None or resume:
             pool_size = settings.pool_size
             self.fake_he_pool = ImagePool(pool_size)
             self.fake_p63_pool = ImagePool(pool_size)
         # endregion
 
+        if resume:
+            self.load_training_state(saved_model_obj)
+
+    # state needed to resume training besides the model weights, saved with every checkpoint
+    def get_training_state(self) -> dict:
+        # without EMA the generators themselves stand in for their averages, as in validation
+        if self.generator_ema is not None:
+            generator_he_to_p63_ema_state_dict, generator_p63_to_he_ema_state_dict = self.generator_ema.state_dicts()
+        else:
+            generator_he_to_p63_ema_state_dict = self.generator_he_to_p63.state_dict()
+            generator_p63_to_he_ema_state_dict = self.generator_p63_to_he.state_dict()
+
+        return {
+            'generator_optimizer_state_dict': self.generator_optimizer.state_dict(),
+            'discriminator_he_optimizer_state_dict': self.discriminator_he_optimizer.state_dict(),
+            'discriminator_p63_optimizer_state_dict': self.discriminator_p63_optimizer.state_dict(),
+            'lr_generator_scheduler_state_dict': self.lr_generator_scheduler.state_dict(),
+            'lr_discriminator_he_scheduler_state_dict': self.lr_discriminator_he_scheduler.state_dict(),
+            'lr_discriminator_p63_scheduler_state_dict': self.lr_discriminator_p63_scheduler.state_dict(),
+            'generator_he_to_p63_ema_state_dict': generator_he_to_p63_ema_state_dict,
+            'generator_p63_to_he_ema_state_dict': generator_p63_to_he_ema_state_dict,
+            'fake_he_pool_state_dict': self.fake_he_pool.state_dict(),
+            'fake_p63_pool_state_dict': self.fake_p63_pool.state_dict(),
+            'sampler_seed': self.sampler_seed,
+            'sampler_state_dict': self.train_sampler.state_dict() if self.track_tile_losses else None,
+            'training_size': self.training_size,
+            'augmentation_state_dict': self.augmentation.state_dict() if self.augmentation is not None else None,
+            'rng_state': {
+                'python': random.getstate(),
+                'numpy': np.random.get_state(),
+                'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            },
+        }
+
+    # restore the state saved by get_training_state, older checkpoints only contain the optimizer states
+    def load_training_state(self, saved_model_obj: dict):
+        self.generator_optimizer.load_state_dict(saved_model_obj['generator_optimizer_state_dict'])
+        self.discriminator_he_optimizer.load_state_dict(saved_model_obj['discriminator_he_optimizer_state_dict'])
+        self.discriminator_p63_optimizer.load_state_dict(saved_model_obj['discriminator_p63_optimizer_state_dict'])
+
+        if 'lr_generator_scheduler_state_dict' in saved_model_obj:
+            self.lr_generator_scheduler.load_state_dict(saved_model_obj['lr_generator_scheduler_state_dict'])
+            self.lr_discriminator_he_scheduler.load_state_dict(
+                saved_model_obj['lr_discriminator_he_scheduler_state_dict'])
+            self.lr_discriminator_p63_scheduler.load_state_dict(
+                saved_model_obj['lr_discriminator_p63_scheduler_state_dict'])
+
+        if self.generator_ema is not None and 'generator_he_to_p63_ema_state_dict' in saved_model_obj:
+            self.generator_ema.load_state_dicts((saved_model_obj['generator_he_to_p63_ema_state_dict'],
+                                                 saved_model_obj['generator_p63_to_he_ema_state_dict']))
+
+        if 'fake_he_pool_state_dict' in saved_model_obj:
+            self.fake_he_pool.load_state_dict(saved_model_obj['fake_he_pool_state_dict'], self.device)
+            self.fake_p63_pool.load_state_dict(saved_model_obj['fake_p63_pool_state_dict'], self.device)
+
+        if 'sampler_seed' in saved_model_obj:
+            self.sampler_seed = saved_model_obj['sampler_seed']
+            self.train_sampler.seed = self.sampler_seed
+
+        if self.track_tile_losses and saved_model_obj.get('sampler_state_dict') is not None:
+            self.train_sampler.load_state_dict(saved_model_obj['sampler_state_dict'])
+
+        # the image pools hold fakes of this size, they are reset if the next step trains at a different one
+        if 'training_size' in saved_model_obj:
+            self.training_size = saved_model_obj['training_size']
+
+        if self.augmentation is not None and saved_model_obj.get('augmentation_state_dict') is not None:
+            self.augmentation.load_state_dict(saved_model_obj['augmentation_state_dict'])
+
+        if 'rng_state' in saved_model_obj:
+            rng_state = saved_model_obj['rng_state']
+            random.setstate(rng_state['python'])
+            np.random.set_state(rng_state['numpy'])
+            torch.set_rng_state(rng_state['torch'].cpu())
+
+            if rng_state['cuda'] is not None and torch.cuda.is_available():
+                torch.cuda.set_rng_state_all([state.cpu() for state in rng_state['cuda']])
+
+    # dataset of a train tile folder, backed by the png files, the tile store or the tar shards packed from them
+    def get_train_dataset(self, settings: Settings, sub_folder: str) -> Dataset:
+        if self.settings.data_backend == 'memmap':
+            return TileStoreDataset(settings.data_root, sub_folder, settings.norm_dict, self.data_transform)
+
+        if self.settings.data_backend == 'shards':
+            return ShardDataset(settings.data_root, sub_folder, settings.norm_dict, self.data_transform,
+                                buffer_size=self.settings.shard_buffer_size,
+                                decode_backend=self.settings.decode_backend)
+
+        # the budget of the tile cache is split between the two domains
+        cache_bytes = self.settings.tile_cache_mib * 2 ** 20 // 2 if self.settings.tile_cache_mib else None
+
+        return DatasetFromFolder(settings.data_root, sub_folder, settings.norm_dict, self.data_transform,
+                                 manifest=self.settings.data_manifest, decode_backend=self.settings.decode_backend,
+                                 cache_bytes=cache_bytes)
+
+    # hit rates and fill of the shared tile caches of the train datasets, empty without caches
+    def get_tile_cache_stats(self) -> dict[str, float]:
+        stats = {}
+
+        for domain, dataset in (('he', getattr(self, 'train_he_data', None)),
+                                ('p63', getattr(self, 'train_p63_data', None))):
+            if getattr(dataset, 'cache', None) is not None:
+                stats.update({f'{domain}_{name}': value for name, value in dataset.cache.stats().items()})
+
+        return stats
+
+    # position the training sampler at the given epoch and step, skipping the batches before it without loading them
+    def set_position(self, epoch: int, step: int = 0):
+        self.global_step = epoch * self.steps_per_epoch + step
+        self.train_sampler.set_position(self.global_step * self.settings.batch_size)
+
+    # crop size used at the given global step, None means the full image size
+    def get_training_size(self, step: int) -> int | None:
+        for size, milestone in zip(self.progressive_sizes, self.progressive_milestones):
+            if step < milestone:
+                return size
+
+        return None
+
+    # switch to the crop size of the current step, fakes and explanations of the previous size are dropped
+    def update_training_size(self):
+        size = self.get_training_size(self.global_step)
+
+        if size != self.training_size:
+            print(f"Step {self.global_step}: training size changed from {self.training_size or 'full'} "
+                  f"to {size or 'full'}")
+            self.training_size = size
+            self.fake_he_pool.reset()
+            self.fake_p63_pool.reset()
+            self.he_explainer.reset()
+            self.p63_explainer.reset()
+
+        # the discriminators have to adapt to the new size, so the adversarial loss of the generators fades in
+        transitions = [milestone for milestone in self.progressive_milestones if milestone <= self.global_step]
+
+        if transitions and self.settings.progressive_fade_steps:
+            steps_since_transition = self.global_step - max(transitions)
+            self.adversarial_scale = min(1.0, steps_since_transition / self.settings.progressive_fade_steps)
+        else:
+            self.adversarial_scale = 1.0
+
+    # decide which auxiliary loss terms are computed in this step and their scale, 0 means skipped
+    def update_loss_scales(self):
+        for name, schedule in self.loss_schedules.items():
+            if isinstance(schedule, int):
+                scale = float(schedule) if self.global_step % schedule == 0 else 0.0
+            else:
+                scale = 1 / schedule if random.random() < schedule else 0.0
+
+            self.loss_scales[name] = scale
+            self.loss_term_counts[name] += scale > 0
+
+        self.loss_schedule_steps += 1
+
+    # share of steps each scheduled term was computed in and the resulting share of generator passes saved
+    def get_loss_schedule_stats(self) -> dict[str, float]:
+        steps = max(self.loss_schedule_steps, 1)
+        stats = {f'{name}_computed_fraction': count / steps for name, count in self.loss_term_counts.items()}
+        stats['generator_passes_saved_fraction'] = \
+            2 * (self.loss_schedule_steps - self.loss_term_counts['identity']) / (GENERATOR_PASSES * steps)
+
+        return stats
+
+    # an independent random crop of every image in the batch
+    @staticmethod
+    def get_random_crops(images: TensorType, size: int) -> TensorType:
+        max_y = images.size(-2) - size
+        max_x = images.size(-1) - size
+
+        if max_y <= 0 and max_x <= 0:
+            return images
+
+        crops = []
+
+        for image in images:
+            y = random.randint(0, max(max_y, 0))
+            x = random.randint(0, max(max_x, 0))
+            crops.append(image[..., y:y + size, x:x + size])
+
+        return torch.stack(crops)
+
     # general function to get loss based on chosen criterion
     def get_loss(self, tensor: TensorType, loss_function: Callable, target_function: Callable) -> torch.Tensor:
         return loss_function(tensor, Variable(target_function(tensor.size()).to(self.device).to(memory_format=torch.channels_last)))
@@ -219,18 +533,21 @@ class TrainingController:
                                               generator: Generator,
                                               discriminator: Discriminator,
                                               explainer: ExplanationController) -> torch.Tensor:
-        fake = generator(real, mask)
+        with self.timer.phase('generator_forward'):
+            fake = generator(real, mask)
+
         disc_fake = discriminator(fake)
         disc_fake_mask = self.discriminator_p63_mask(fake * mask)
         generator_loss = self.get_loss(disc_fake, self.criterion_GAN, torch.ones)
         generator_mask_loss = self.get_loss(disc_fake_mask, self.criterion_GAN, torch.ones)
 
-        explainer.set_explanation(fake)
-        explainer.set_explanation_m(fake * mask)
+        with self.timer.phase('explainer_saliency'):
+            explainer.set_explanation(fake)
+            explainer.set_explanation_m(fake * mask)
 
         return (self.settings.lambda_mask_adversarial_ratio * generator_mask_loss
                 + (1 - self.settings.lambda_mask_adversarial_ratio)
-                * generator_loss) * self.settings.lambda_adversarial
+                * generator_loss) * self.settings.lambda_adversarial * self.adversarial_scale
 
     # get total loss for cycle consistency
     def get_total_cycle_loss(self, cycled: TensorType, other_mask: TensorType,
@@ -259,16 +576,28 @@ class TrainingController:
 
         return (discriminator_real_loss + discriminator_fake_loss) * 0.5 * coefficient
 
-    # training step
-    def training_step(self, real_he: TensorType, real_p63: TensorType):
-        min_dim = min(real_he.size(0), real_p63.size(0))
-        real_he = real_he[:min_dim]
-        real_p63 = real_p63[:min_dim]
+    # unmasked L1 cycle and identity loss of every sample, weighted like the training losses
+    def get_tile_loss(self, real: TensorType, cycled: TensorType, identity: TensorType) -> torch.Tensor:
+        cycle_loss = (cycled.float() - real).abs().mean(dim=(1, 2, 3))
+        identity_loss = (identity.float() - real).abs().mean(dim=(1, 2, 3))
 
-        (real_he, mask_he), (real_p63, mask_p63) = self.get_dummies(real_he, real_p63)
+        return cycle_loss * self.settings.lambda_cycle + identity_loss * self.settings.lambda_identity
+
+    # split a batch into micro-batches of at most settings.micro_batch_size samples
+    def get_micro_batches(self, *tensors: TensorType) -> list[tuple[TensorType, ...]]:
+        micro_batch_size = self.settings.micro_batch_size
+
+        if not micro_batch_size or micro_batch_size >= tensors[0].size(0):
+            return [tensors]
+
+        return list(zip(*(tensor.split(micro_batch_size) for tensor in tensors)))
 
+    # forward and backward pass of both generators for a single micro-batch, gradients are accumulated
+    def generator_step(self, real_he: TensorType, mask_he: TensorType, real_p63: TensorType, mask_p63: TensorType,
+                       loss_scale: float = 1.0) -> tuple[tuple[TensorType, ...], dict[str, torch.Tensor]]:
         # cast to bfloat16 for forward pass, it's faster
         with torch.autocast(device_type="cuda", dtype=self.half_precision):
+            self.timer.start('generator_forward')
             fake_p63 = self.generator_he_to_p63(real_he, mask_he)
             cycled_he = self.generator_p63_to_he(fake_p63, mask_he)
 
@@ -279,15 +608,20 @@ class TrainingController:
 
             fake_he = self.generator_p63_to_he(real_p63, mask_p63)
             cycled_p63 = self.generator_he_to_p63(fake_he, mask_p63)
-            
+
             encoded_p63_in_p63_to_he = self.generator_p63_to_he.enc4
             converted_fhe_in_he_to_p63 = self.generator_he_to_p63.res_out
             converted_p63_in_p63_to_he = self.generator_p63_to_he.res_out
             encoded_fhe_in_he_to_p63 = self.generator_he_to_p63.enc4
+            self.timer.stop('generator_forward')
 
             # set explanations
+            self.timer.start('explainer_saliency')
             self.p63_explainer.set_explanation_m(fake_p63 * mask_he)
             self.he_explainer.set_explanation_m(fake_he * mask_p63)
+            self.timer.stop('explainer_saliency')
+
+            self.timer.start('loss_computation')
 
             # using no grad here due to doubling gradients... explainer automatically resets gradients
             with torch.no_grad():
@@ -330,24 +664,45 @@ class TrainingController:
             # total cycle loss
             cycle_loss = (cycle_he_loss_total + cycle_p63_loss_total) * self.settings.lambda_cycle
 
-            # identity loss
-            identity_he = self.criterion_pixel_wise(real_he, self.generator_p63_to_he(real_he, mask_he))
-
-            identity_p63 = self.criterion_pixel_wise(real_p63, self.generator_he_to_p63(real_p63, mask_p63))
-
-            identity_loss = (identity_he + identity_p63) * self.settings.lambda_identity
-
-            context_loss = torch.nn.functional.huber_loss(encoded_he_in_he_to_p63, converted_fp63_in_p63_to_he) + \
-                torch.nn.functional.huber_loss(converted_he_in_he_to_p63, encoded_fp63_in_p63_to_he)
-
-            context_loss /= 2
-            context_loss *= self.settings.lambda_context
+            # auxiliary losses, computed only in the steps scheduled by update_loss_scales
+            auxiliary_losses = {}
 
-            cycle_context_loss = torch.nn.functional.huber_loss(encoded_p63_in_p63_to_he, converted_fhe_in_he_to_p63) + \
-                torch.nn.functional.huber_loss(converted_p63_in_p63_to_he, encoded_fhe_in_he_to_p63)
-
-            cycle_context_loss /= 2
-            cycle_context_loss *= self.settings.lambda_cycle_context
+            # identity loss
+            if self.loss_scales['identity']:
+                with self.timer.phase('generator_forward'):
+                    identity_he_fake = self.generator_p63_to_he(real_he, mask_he)
+                    identity_he = self.criterion_pixel_wise(real_he, identity_he_fake)
+
+                    identity_p63_fake = self.generator_he_to_p63(real_p63, mask_p63)
+                    identity_p63 = self.criterion_pixel_wise(real_p63, identity_p63_fake)
+
+                # per-tile cycle and identity loss for the loss-aware sampler
+                if self.track_tile_losses:
+                    with torch.no_grad():
+                        self.tile_losses.append((
+                            self.get_tile_loss(real_he, cycled_he, identity_he_fake),
+                            self.get_tile_loss(real_p63, cycled_p63, identity_p63_fake)
+                        ))
+
+                identity_loss = (identity_he + identity_p63) * self.settings.lambda_identity
+                auxiliary_losses['identity'] = torch.nan_to_num(identity_loss, nan=0, posinf=1, neginf=-1)
+
+            if self.loss_scales['context']:
+                context_loss = torch.nn.functional.huber_loss(encoded_he_in_he_to_p63, converted_fp63_in_p63_to_he) + \
+                    torch.nn.functional.huber_loss(converted_he_in_he_to_p63, encoded_fp63_in_p63_to_he)
+
+                context_loss /= 2
+                context_loss *= self.settings.lambda_context
+                auxiliary_losses['context'] = context_loss
+
+            if self.loss_scales['cycle_context']:
+                cycle_context_loss = \
+                    torch.nn.functional.huber_loss(encoded_p63_in_p63_to_he, converted_fhe_in_he_to_p63) + \
+                    torch.nn.functional.huber_loss(converted_p63_in_p63_to_he, encoded_fhe_in_he_to_p63)
+
+                cycle_context_loss /= 2
+                cycle_context_loss *= self.settings.lambda_cycle_context
+                auxiliary_losses['cycle_context'] = cycle_context_loss
 
             # using no grad here due to doubling gradients... explainer automatically resets gradients
             with torch.no_grad():
@@ -380,137 +735,277 @@ class TrainingController:
             generator_he_to_p63_total_loss = torch.nan_to_num(generator_he_to_p63_total_loss, nan=0, posinf=1, neginf=-1)
             generator_p63_to_he_total_loss = torch.nan_to_num(generator_p63_to_he_total_loss, nan=0, posinf=1, neginf=-1)
             cycle_loss = torch.nan_to_num(cycle_loss, nan=0, posinf=1, neginf=-1)
-            identity_loss = torch.nan_to_num(identity_loss, nan=0, posinf=1, neginf=-1)
 
             # backward gen
             generator_loss = \
                 + generator_he_to_p63_total_loss \
                 + generator_p63_to_he_total_loss \
-                + cycle_loss \
-                + identity_loss \
-                + context_loss \
-                + cycle_context_loss
+                + cycle_loss
+
+            for name, loss in auxiliary_losses.items():
+                generator_loss = generator_loss + loss * self.loss_scales[name]
+
+        self.timer.stop('loss_computation')
+
+        # the explanation hooks use the explanation maps of this micro-batch, so backward has to happen here
+        with self.timer.phase('generator_backward'):
+            (generator_loss * loss_scale).backward()
+
+        # the auxiliary losses are reported unscaled and only in the steps they were computed in, the scaled total
+        # that was backpropagated jumps with the schedules and is reported separately
+        losses = {
+            'generator': (generator_he_to_p63_total_loss + generator_p63_to_he_total_loss + cycle_loss +
+                          sum(auxiliary_losses.values())).detach(),
+            'generator_scheduled': generator_loss.detach(),
+            'generator_he_to_p63': generator_he_to_p63_total_loss.detach(),
+            'generator_p63_to_he': generator_p63_to_he_total_loss.detach(),
+            'cycle': cycle_loss.detach(),
+            **{name: loss.detach() for name, loss in auxiliary_losses.items()}
+        }
+
+        return (real_he, mask_he, fake_he.detach(), real_p63, mask_p63, fake_p63.detach()), losses
+
+    # forward and backward pass of a discriminator pair for a single micro-batch, gradients are accumulated
+    def discriminator_step(self, real: TensorType, real_mask: TensorType, fake: TensorType, fake_mask: TensorType,
+                           discriminator: Discriminator, discriminator_mask: Discriminator,
+                           pool: ImagePool, loss_scale: float = 1.0, neginf: float = -1) -> torch.Tensor:
+        with torch.autocast(device_type="cuda", dtype=self.half_precision):
+            discriminator_loss_partial = self.get_partial_disc_loss(real, fake, discriminator,
+                                                                    1 - self.settings.lambda_mask_adversarial_ratio,
+                                                                    pool)
 
-        self.generator_optimizer.zero_grad(set_to_none=True)
-        generator_loss.backward()
+            discriminator_loss_mask_partial = self.get_partial_disc_loss(real * real_mask, fake * fake_mask,
+                                                                         discriminator_mask,
+                                                                         self.settings.lambda_mask_adversarial_ratio,
+                                                                         pool)
 
-        for param_he_to_p63, param_p63_to_he in zip(self.generator_he_to_p63.parameters(), self.generator_p63_to_he.parameters()):
-            param_he_to_p63.grad.data.clamp(-1, 1)
-            param_p63_to_he.grad.data.clamp(-1, 1)
+            discriminator_loss = discriminator_loss_partial + discriminator_loss_mask_partial
 
-        self.generator_optimizer.step()
+        discriminator_loss = torch.nan_to_num(discriminator_loss, nan=0, posinf=1, neginf=neginf)
+        (discriminator_loss * loss_scale).backward()
 
-        # Back propagation for discriminators
-        with torch.autocast(device_type="cuda", dtype=self.half_precision):
-            discriminator_he_loss_partial = self.get_partial_disc_loss(real_he, fake_he, self.discriminator_he,
-                                                                       1 - self.settings.lambda_mask_adversarial_ratio,
-                                                                       self.fake_he_pool)
+        return discriminator_loss.detach()
 
-            discriminator_he_loss_mask_partial = self.get_partial_disc_loss(real_he * mask_he, fake_he * mask_p63,
-                                                                            self.discriminator_he_mask,
-                                                                            self.settings.lambda_mask_adversarial_ratio,
-                                                                            self.fake_he_pool)
+    # training step, the batch is split into micro-batches and the gradients accumulated if micro_batch_size is set
+    def training_step(self, real_he: TensorType, real_p63: TensorType, he_index: torch.Tensor = None,
+                      p63_index: torch.Tensor = None):
+        min_dim = min(real_he.size(0), real_p63.size(0))
+        real_he = real_he[:min_dim]
+        real_p63 = real_p63[:min_dim]
 
-            discriminator_he_loss = discriminator_he_loss_partial + discriminator_he_loss_mask_partial
+        self.update_training_size()
+        self.update_loss_scales()
 
-        self.discriminator_he_optimizer.zero_grad(set_to_none=True)
-        discriminator_he_loss = torch.nan_to_num(discriminator_he_loss, nan=0, posinf=1, neginf=0)
-        discriminator_he_loss.backward()
+        if self.training_size is not None:
+            real_he = self.get_random_crops(real_he, self.training_size)
+            real_p63 = self.get_random_crops(real_p63, self.training_size)
 
-        for param_disc_he, param_disc_mask_he in zip(self.discriminator_he.parameters(), self.discriminator_he_mask.parameters()):
-            param_disc_he.grad.data.clamp(-1, 1)
-            param_disc_mask_he.grad.data.clamp(-1, 1)
+        with self.timer.phase('mask_creation'):
+            (real_he, mask_he), (real_p63, mask_p63) = self.get_dummies(real_he, real_p63, augment=True)
 
-        self.discriminator_he_optimizer.step()
+        # the last micro-batch may be smaller, every micro-batch is weighted by its share of the batch
+        micro_batches = self.get_micro_batches(real_he, mask_he, real_p63, mask_p63)
+        weights = [micro_batch[0].size(0) / min_dim for micro_batch in micro_batches]
 
-        with torch.autocast(device_type="cuda", dtype=self.half_precision):
-            discriminator_p63_loss_partial = self.get_partial_disc_loss(real_p63, fake_p63, self.discriminator_p63,
-                                                                        1 - self.settings.lambda_mask_adversarial_ratio,
-                                                                        self.fake_p63_pool)
+        self.generator_optimizer.zero_grad(set_to_none=True)
+        generator_results = [self.generator_step(*micro_batch, weight)
+                             for micro_batch, weight in zip(micro_batches, weights)]
+
+        if self.track_tile_losses:
+            if self.tile_losses and he_index is not None and p63_index is not None:
+                tile_losses_he, tile_losses_p63 = (torch.cat(losses).tolist() for losses in zip(*self.tile_losses))
+                self.train_sampler.update(0, he_index[:min_dim], tile_losses_he)
+                self.train_sampler.update(1, p63_index[:min_dim], tile_losses_p63)
 
-            discriminator_p63_loss_mask_partial = self.get_partial_disc_loss(real_p63 * mask_p63, fake_p63 * mask_he,
-                                                                             self.discriminator_p63_mask,
-                                                                             self.settings.lambda_mask_adversarial_ratio,
-                                                                             self.fake_p63_pool)
+            self.tile_losses = []
 
-            discriminator_p63_loss = discriminator_p63_loss_partial + discriminator_p63_loss_mask_partial
+        with self.timer.phase('generator_optimizer_step'):
+            for param_he_to_p63, param_p63_to_he in zip(self.generator_he_to_p63.parameters(), self.generator_p63_to_he.parameters()):
+                param_he_to_p63.grad.data.clamp(-1, 1)
+                param_p63_to_he.grad.data.clamp(-1, 1)
 
-        self.discriminator_p63_optimizer.zero_grad(set_to_none=True)
-        discriminator_p63_loss = torch.nan_to_num(discriminator_p63_loss, nan=0, posinf=1, neginf=-1)
-        discriminator_p63_loss.backward()
+            self.generator_optimizer.step()
 
-        for param_disc_p63, param_disc_mask_p63 in zip(self.discriminator_p63.parameters(), self.discriminator_p63_mask.parameters()):
-            param_disc_p63.grad.data.clamp(-1, 1)
-            param_disc_mask_p63.grad.data.clamp(-1, 1)
+            if self.generator_ema is not None:
+                self.generator_ema.update()
+
+        # Back propagation for discriminators
+        with self.timer.phase('discriminator_he_update'):
+            self.discriminator_he_optimizer.zero_grad(set_to_none=True)
+            discriminator_he_loss = sum(
+                self.discriminator_step(real_he, mask_he, fake_he, mask_p63,
+                                        self.discriminator_he, self.discriminator_he_mask, self.fake_he_pool, weight,
+                                        neginf=0)
+                * weight
+                for ((real_he, mask_he, fake_he, _, mask_p63, _), _), weight in zip(generator_results, weights)
+            )
 
-        self.discriminator_p63_optimizer.step()
+            for param_disc_he, param_disc_mask_he in zip(self.discriminator_he.parameters(), self.discriminator_he_mask.parameters()):
+                param_disc_he.grad.data.clamp(-1, 1)
+                param_disc_mask_he.grad.data.clamp(-1, 1)
 
-        # logging losses
-        self.latest_generator_loss = generator_loss.item()
+            self.discriminator_he_optimizer.step()
+
+        with self.timer.phase('discriminator_p63_update'):
+            self.discriminator_p63_optimizer.zero_grad(set_to_none=True)
+            discriminator_p63_loss = sum(
+                self.discriminator_step(real_p63, mask_p63, fake_p63, mask_he,
+                                        self.discriminator_p63, self.discriminator_p63_mask, self.fake_p63_pool, weight)
+                * weight
+                for ((_, mask_he, _, real_p63, mask_p63, fake_p63), _), weight in zip(generator_results, weights)
+            )
+
+            for param_disc_p63, param_disc_mask_p63 in zip(self.discriminator_p63.parameters(), self.discriminator_p63_mask.parameters()):
+                param_disc_p63.grad.data.clamp(-1, 1)
+                param_disc_mask_p63.grad.data.clamp(-1, 1)
+
+            self.discriminator_p63_optimizer.step()
+
+        self.timer.start('logging')
+
+        # average the losses of all micro-batches, weighted by their sizes
+        losses = {name: sum(result[1][name] * weight for result, weight in zip(generator_results, weights)).item()
+                  for name in generator_results[0][1]}
+
+        # logging losses, the skipped auxiliary terms count with their latest value, so the total follows the
+        # unscheduled loss
+        skipped_losses = [getattr(self, f'latest_{name}_loss') for name in self.loss_schedules if name not in losses]
+        self.latest_generator_loss = losses['generator'] + sum(loss for loss in skipped_losses if loss is not None)
+        self.latest_scheduled_generator_loss = losses['generator_scheduled']
         self.latest_discriminator_he_loss = discriminator_he_loss.item()
         self.latest_discriminator_p63_loss = discriminator_p63_loss.item()
-        self.latest_identity_loss = identity_loss.item()
-        self.latest_cycle_loss = cycle_loss.item()
-        self.latest_context_loss = context_loss.item()
-        self.latest_cycle_context_loss = cycle_context_loss.item()
+        self.latest_identity_loss = losses.get('identity', self.latest_identity_loss)
+        self.latest_cycle_loss = losses['cycle']
+        self.latest_context_loss = losses.get('context', self.latest_context_loss)
+        self.latest_cycle_context_loss = losses.get('cycle_context', self.latest_cycle_context_loss)
 
         if torch.multiprocessing.current_process().name == 'MainProcess':
-            self.wandb_module.discriminator_he_running_loss_avg.append(discriminator_he_loss.item())
-            self.wandb_module.discriminator_p63_running_loss_avg.append(discriminator_p63_loss.item())
-            self.wandb_module.generator_he_to_p63_running_loss_avg.append(generator_he_to_p63_total_loss.item())
-            self.wandb_module.generator_p63_to_he_running_loss_avg.append(generator_p63_to_he_total_loss.item())
-            self.wandb_module.cycle_he_running_loss_avg.append(cycle_loss.item())
-            self.wandb_module.cycle_p63_running_loss_avg.append(cycle_loss.item())
-            self.wandb_module.total_running_loss_avg.append(generator_loss.item())
-            self.wandb_module.context_running_loss_avg.append(context_loss.item())
-            self.wandb_module.cycle_context_running_loss_avg.append(cycle_context_loss.item())
-
-    # evaluation step
-    def get_image_pairs(self):
-        real_he = self.test_he_data.get_sequential_image()
-        real_p63 = self.test_p63_data.get_sequential_image()
+            self.wandb_module.discriminator_he_running_loss_avg.append(self.latest_discriminator_he_loss)
+            self.wandb_module.discriminator_p63_running_loss_avg.append(self.latest_discriminator_p63_loss)
+            self.wandb_module.generator_he_to_p63_running_loss_avg.append(losses['generator_he_to_p63'])
+            self.wandb_module.generator_p63_to_he_running_loss_avg.append(losses['generator_p63_to_he'])
+            self.wandb_module.cycle_he_running_loss_avg.append(losses['cycle'])
+            self.wandb_module.cycle_p63_running_loss_avg.append(losses['cycle'])
+            self.wandb_module.total_running_loss_avg.append(self.latest_generator_loss)
+            self.wandb_module.scheduled_total_running_loss_avg.append(self.latest_scheduled_generator_loss)
 
-        real_he = Variable(real_he.to(self.device)).expand(1, -1, -1, -1).to(memory_format=torch.channels_last)
-        real_p63 = Variable(real_p63.to(self.device)).expand(1, -1, -1, -1).to(memory_format=torch.channels_last)
+            if 'context' in losses:
+                self.wandb_module.context_running_loss_avg.append(losses['context'])
 
-        real_he_mask = get_mask(real_he, self.settings.mask_type)
-        real_p63_mask = get_mask(real_p63, self.settings.mask_type)
+            if 'cycle_context' in losses:
+                self.wandb_module.cycle_context_running_loss_avg.append(losses['cycle_context'])
 
-        real_he_mask = Variable(real_he_mask.to(self.device).to(memory_format=torch.channels_last))
-        real_p63_mask = Variable(real_p63_mask.to(self.device).to(memory_format=torch.channels_last))
+        self.timer.stop('logging')
+        self.timer.step()
 
-        fake_p63 = self.generator_he_to_p63(real_he, real_he_mask)
-        reconstructed_he = self.generator_p63_to_he(fake_p63, real_he_mask)
+        self.global_step += 1
 
-        fake_he = self.generator_p63_to_he(real_p63, real_p63_mask)
-        reconstructed_p63 = self.generator_he_to_p63(fake_he, real_p63_mask)
+    # translate a pair of test images in both directions, without autograd and with the EMA generators if available
+    @torch.inference_mode()
+    def translate_pair(self, real_he: TensorType, real_p63: TensorType):
+        real_he = self.device_transform(real_he.to(self.device).expand(1, -1, -1, -1))
+        real_p63 = self.device_transform(real_p63.to(self.device).expand(1, -1, -1, -1))
+        real_he = real_he.to(memory_format=torch.channels_last)
+        real_p63 = real_p63.to(memory_format=torch.channels_last)
 
-        return (real_he, real_p63), (fake_he, fake_p63), (reconstructed_he, reconstructed_p63)
+        # masks of both domains are computed in one batch
+        real_he_mask, real_p63_mask = get_mask(torch.cat((real_he, real_p63)), self.settings.mask_type).chunk(2)
+        real_he_mask = real_he_mask.to(self.device).to(memory_format=torch.channels_last)
+        real_p63_mask = real_p63_mask.to(self.device).to(memory_format=torch.channels_last)
 
-    def get_image_pairs_paired(self):
-        real_he = self.test_he_data.get_sequential_image2()
-        real_p63 = self.test_p63_data.get_sequential_image2()
+        fake_p63 = self.generator_he_to_p63_ema(real_he, real_he_mask)
+        fake_he = self.generator_p63_to_he_ema(real_p63, real_p63_mask)
 
-        real_he = Variable(real_he.to(self.device)).expand(1, -1, -1, -1).to(memory_format=torch.channels_last)
-        real_p63 = Variable(real_p63.to(self.device)).expand(1, -1, -1, -1).to(memory_format=torch.channels_last)
+        reconstructed_he = self.generator_p63_to_he_ema(fake_p63, real_he_mask)
+        reconstructed_p63 = self.generator_he_to_p63_ema(fake_he, real_p63_mask)
 
-        real_he_mask = get_mask(real_he, self.settings.mask_type)
-        real_p63_mask = get_mask(real_p63, self.settings.mask_type)
+        return (real_he, real_p63), (fake_he, fake_p63), (reconstructed_he, reconstructed_p63)
 
-        real_he_mask = Variable(real_he_mask.to(self.device).to(memory_format=torch.channels_last))
-        real_p63_mask = Variable(real_p63_mask.to(self.device).to(memory_format=torch.channels_last))
+    # evaluation step, cycles through a fixed set of test images which is loaded to the device only once
+    def get_image_pairs(self):
+        if self.visualisation_he is None:
+            samples = self.settings.visualisation_samples
+            self.visualisation_he = torch.stack(
+                [self.test_he_data[i] for i in range(min(samples, len(self.test_he_data)))]).to(self.device)
+            self.visualisation_p63 = torch.stack(
+                [self.test_p63_data[i] for i in range(min(samples, len(self.test_p63_data)))]).to(self.device)
+
+        real_he = self.visualisation_he[self.visualisation_index % self.visualisation_he.size(0)]
+        real_p63 = self.visualisation_p63[self.visualisation_index % self.visualisation_p63.size(0)]
+        self.visualisation_index += 1
+
+        return self.translate_pair(real_he, real_p63)
+
+    # evenly spaced samples of a dataset stacked into one tensor on the device
+    def load_subset(self, dataset, samples: int) -> torch.Tensor:
+        indices = np.unique(np.linspace(0, len(dataset) - 1, min(samples, len(dataset))).round().astype(int))
+        subset = self.device_transform(torch.stack([dataset[i] for i in indices]).to(self.device))
+        return subset.to(memory_format=torch.channels_last)
+
+    # load the validation subset and its masks once, the masks are fixed so that the results are comparable
+    def load_validation_data(self):
+        samples = self.settings.validation_samples
+        self.validation_he = self.load_subset(self.test_he_data, samples)
+        self.validation_p63 = self.load_subset(self.test_p63_data, samples)
+
+        batch_size = self.settings.validation_batch_size or self.settings.batch_size
+
+        with torch.inference_mode():
+            self.validation_he_mask = torch.cat([get_mask(batch, self.settings.mask_type).to(self.device)
+                                                 for batch in self.validation_he.split(batch_size)])
+            self.validation_p63_mask = torch.cat([get_mask(batch, self.settings.mask_type).to(self.device)
+                                                  for batch in self.validation_p63.split(batch_size)])
+
+        self.validation_he_mask = self.validation_he_mask.contiguous(memory_format=torch.channels_last)
+        self.validation_p63_mask = self.validation_p63_mask.contiguous(memory_format=torch.channels_last)
+
+    # cycle consistency SSIM and PSNR of the validation subset, computed in batches on the device with the EMA generators
+    @torch.inference_mode()
+    def validate(self) -> dict[str, float]:
+        if self.validation_he is None:
+            self.load_validation_data()
+
+        batch_size = self.settings.validation_batch_size or self.settings.batch_size
+        results = {}
+
+        for domain, real, mask, generator, other_generator in (
+                ('he', self.validation_he, self.validation_he_mask,
+                 self.generator_he_to_p63_ema, self.generator_p63_to_he_ema),
+                ('p63', self.validation_p63, self.validation_p63_mask,
+                 self.generator_p63_to_he_ema, self.generator_he_to_p63_ema)):
+            ssim_values = []
+            psnr_values = []
+
+            for real_batch, mask_batch in zip(real.split(batch_size), mask.split(batch_size)):
+                cycled_batch = other_generator(generator(real_batch, mask_batch), mask_batch)
+
+                real_rgb = denormalize_images(real_batch)
+                cycled_rgb = denormalize_images(cycled_batch)
+
+                ssim_values.append(ssim(cycled_rgb, real_rgb, data_range=1.0, reduction='none'))
+                psnr_values.append(psnr(cycled_rgb, real_rgb, data_range=1.0, reduction='none', dim=(1, 2, 3)))
+
+            results[f'ssim_{domain}'] = torch.cat(ssim_values).mean()
+            results[f'psnr_{domain}'] = torch.cat(psnr_values).mean()
+
+        # a single transfer of all results
+        return dict(zip(results, torch.stack(list(results.values())).tolist()))
 
-        fake_p63 = self.generator_he_to_p63(real_he, real_he_mask)
-        reconstructed_he = self.generator_p63_to_he(fake_p63, real_he_mask)
+    def get_image_pairs_paired(self):
+        return self.translate_pair(self.test_he_data.get_sequential_image2(), self.test_p63_data.get_sequential_image2())
 
-        fake_he = self.generator_p63_to_he(real_p63, real_p63_mask)
-        reconstructed_p63 = self.generator_he_to_p63(fake_he, real_p63_mask)
+    # the masks are computed after the augmentation, so they match the augmented images
+    def get_dummies(self, real_he, real_p63, augment: bool = False) -> tuple[tuple[TensorType, TensorType],
+                                                                             tuple[TensorType, TensorType]]:
+        real_he = self.device_transform(real_he.to(self.device, non_blocking=True))
+        real_p63 = self.device_transform(real_p63.to(self.device, non_blocking=True))
 
-        return (real_he, real_p63), (fake_he, fake_p63), (reconstructed_he, reconstructed_p63)
+        if augment and self.augmentation is not None:
+            real_he = self.augmentation(real_he)
+            real_p63 = self.augmentation(real_p63)
 
-    def get_dummies(self, real_he, real_p63) -> tuple[tuple[TensorType, TensorType], tuple[TensorType, TensorType]]:
-        real_he = Variable(real_he.to(self.device).to(memory_format=torch.channels_last))
-        real_p63 = Variable(real_p63.to(self.device).to(memory_format=torch.channels_last))
+        real_he = Variable(real_he.to(memory_format=torch.channels_last))
+        real_p63 = Variable(real_p63.to(memory_format=torch.channels_last))
         mask_he = get_mask(real_he, self.settings.mask_type)
         mask_p63 = get_mask(real_p63, self.settings.mask_type)
         mask_he = Variable(mask_he.to(self.device).to(memory_format=torch.channels_last))
@@ -521,9 +1016,9 @@ class TrainingController:
     def eval_step(self, real_he: TensorType, real_p63: TensorType):
         (real_he, mask_he), (real_p63, mask_p63) = self.get_dummies(real_he, real_p63)
 
-        fake_p63 = self.generator_he_to_p63(real_he, mask_he)
-        fake_he = self.generator_p63_to_he(real_p63, mask_p63)
-        cycled_he = self.generator_p63_to_he(fake_p63, mask_he)
-        cycled_p63 = self.generator_he_to_p63(fake_he, mask_p63)
+        fake_p63 = self.generator_he_to_p63_ema(real_he, mask_he)
+        fake_he = self.generator_p63_to_he_ema(real_p63, mask_p63)
+        cycled_he = self.generator_p63_to_he_ema(fake_p63, mask_he)
+        cycled_p63 = self.generator_he_to_p63_ema(fake_he, mask_p63)
 
         return fake_he, cycled_he, fake_p63, cycled_p63
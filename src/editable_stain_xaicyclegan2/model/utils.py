@@ -2,8 +2,10 @@
     Prevzatý kód
 """
 
+import copy
 import random
 
+import torch
 from torch import cat, unsqueeze
 from torch.autograd import Variable
 
@@ -48,3 +50,45 @@ class ImagePool:  # Image pool for fake images
                     return_images.append(image)
         return_images = Variable(cat(return_images, 0)) # Return images as a tensor
         return return_images
+
+    def reset(self):  # Empty the pool, e.g. when the size of the images changes
+        if self.pool_size > 0:
+            self.num_images = 0
+            self.images = []
+
+    def state_dict(self):  # Pool contents, saved with the checkpoint to resume training
+        if self.pool_size == 0:
+            return {}
+        return {'num_images': self.num_images, 'images': list(self.images)}
+
+    def load_state_dict(self, state_dict, device=None):
+        if self.pool_size == 0:
+            return
+        self.num_images = state_dict['num_images']
+        self.images = [image.to(device) if device is not None else image for image in state_dict['images']]
+
+
+class ModelEMA:  # Exponential moving average of the weights of several models, updated in a single fused pass
+    def __init__(self, models, decay=0.999):
+        self.decay = decay
+        self.ema_models = [copy.deepcopy(model).eval().requires_grad_(False) for model in models]
+
+        self.params = [param for model in models for param in model.parameters()]
+        self.ema_params = [param for model in self.ema_models for param in model.parameters()]
+        self.buffers = [buffer for model in models for buffer in model.buffers()]
+        self.ema_buffers = [buffer for model in self.ema_models for buffer in model.buffers()]
+
+    @torch.no_grad()
+    def update(self):  # Call after every optimizer step
+        torch._foreach_mul_(self.ema_params, self.decay)
+        torch._foreach_add_(self.ema_params, self.params, alpha=1 - self.decay)
+
+        for ema_buffer, buffer in zip(self.ema_buffers, self.buffers):  # e.g. spectral norm vectors, not averaged
+            ema_buffer.copy_(buffer)
+
+    def state_dicts(self):
+        return [model.state_dict() for model in self.ema_models]
+
+    def load_state_dicts(self, state_dicts):
+        for model, state_dict in zip(self.ema_models, state_dicts):
+            model.load_state_dict(state_dict)
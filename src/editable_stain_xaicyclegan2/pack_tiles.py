@@ -0,0 +1,118 @@
+"""
+    Prevzatý kód
+"""
+
+import json
+import os
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from editable_stain_xaicyclegan2.model.dataset import get_tile_store_paths
+from editable_stain_xaicyclegan2.setup.settings_module import Settings
+
+
+# decodes a tile the same way DatasetFromFolder does, None if the file is corrupt
+def decode_tile(path: str, size: int):
+    try:
+        img = Image.open(path).convert('RGB')
+    except (OSError, SyntaxError) as e:
+        print(f"{path}: {e}")
+        return None
+
+    if size:
+        img = img.resize((size, size), Image.BILINEAR)
+
+    return np.asarray(img, dtype=np.uint8)
+
+
+def pack_tiles(image_dir: str, sub_folder: str, size: int = 256, workers: int = None, chunk_size: int = 64) -> dict:
+    """
+    Decodes and resizes every tile of a folder once and writes them into a single uint8 array of shape
+    (N, size, size, 3), saved as <folder>.npy, and the filenames of its rows into <folder>.json.
+    The tiles are written in chunks, so the folder never has to fit into memory.
+
+    :param image_dir: path to the folder containing the tile folders
+    :param sub_folder: tile folder to pack, e.g. 'train/p63'
+    :param size: width and height the tiles are resized to, the resize of DatasetFromFolder
+    :param workers: number of decoding processes, by default the number of cpus
+    :param chunk_size: number of tiles decoded at once by a worker
+    :return: the index written next to the store
+    """
+
+    input_path = os.path.join(image_dir, sub_folder)
+    store_path, index_path = get_tile_store_paths(image_dir, sub_folder)
+    filenames = sorted(os.listdir(input_path))
+    paths = [os.path.join(input_path, filename) for filename in filenames]
+
+    # written under a temporary name, a store that is still being packed is never picked up by training
+    partial_path = store_path + '.partial'
+    images = np.lib.format.open_memmap(partial_path, mode='w+', dtype=np.uint8, shape=(len(paths), size, size, 3))
+
+    packed = []
+    skipped = []
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        tiles = executor.map(decode_tile, paths, [size] * len(paths), chunksize=chunk_size)
+
+        for filename, tile in zip(filenames, tiles):
+            if tile is None:
+                skipped.append(filename)
+                continue
+
+            images[len(packed)] = tile
+            packed.append(filename)
+
+    images.flush()
+    del images
+
+    # corrupt tiles leave unused rows at the end, the header is rewritten with the packed length
+    if skipped:
+        full = np.load(partial_path, mmap_mode='r')
+        images = np.lib.format.open_memmap(store_path, mode='w+', dtype=np.uint8, shape=(len(packed), size, size, 3))
+        images[:] = full[:len(packed)]
+        images.flush()
+        del images, full
+        os.remove(partial_path)
+    else:
+        os.replace(partial_path, store_path)
+
+    index = {
+        'source': os.path.abspath(input_path),
+        'size': size,
+        'shape': [len(packed), size, size, 3],
+        'filenames': packed,
+        'skipped': skipped
+    }
+
+    with open(index_path, 'w') as file:
+        json.dump(index, file)
+
+    return index
+
+
+def main():
+    parser = ArgumentParser(description='Packs tile folders into memory-mapped stores of decoded tiles, '
+                                        'used by training with data_backend=\'memmap\'.')
+    parser.add_argument('--settings', type=str, default='settings.cfg', help='Settings file with the data paths')
+    parser.add_argument('--folders', type=str, nargs='+', help='Tile folders in data_root to pack, '
+                                                               'by default data_train_he and data_train_p63')
+    parser.add_argument('--size', type=int, default=256, help='Width and height of the packed tiles')
+    parser.add_argument('--workers', type=int, help='Number of decoding processes')
+    args = parser.parse_args()
+
+    settings = Settings(args.settings)
+    folders = args.folders or [settings.data_train_he, settings.data_train_p63]
+
+    for folder in folders:
+        index = pack_tiles(settings.data_root, folder, args.size, args.workers)
+        store_path, _ = get_tile_store_paths(settings.data_root, folder)
+        size = os.path.getsize(store_path) / 2 ** 30
+        print(f"{folder}: {len(index['filenames'])} tiles packed into {store_path} ({size:.2f} GiB), "
+              f"{len(index['skipped'])} corrupt tiles skipped")
+
+
+if __name__ == '__main__':
+    main()
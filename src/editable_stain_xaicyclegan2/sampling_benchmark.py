@@ -0,0 +1,116 @@
+"""
+    Prevzatý kód
+"""
+
+import copy
+import json
+import os
+import random
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+from editable_stain_xaicyclegan2.benchmark import StubWandbModule
+from editable_stain_xaicyclegan2.model.training_controller import TrainingController
+from editable_stain_xaicyclegan2.setup.settings_module import Settings
+
+
+def seed_everything(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def run_sampling(settings: Settings, sampling: str, seconds: float, validation_interval: float,
+                 seed: int = 0) -> dict:
+    """
+    Trains on the dataset of the settings for a wall-clock budget and validates at fixed intervals.
+    The time spent validating is not counted towards the budget.
+
+    :param settings: training settings
+    :param sampling: 'uniform' or 'loss'
+    :param seconds: training time budget
+    :param validation_interval: training seconds between validation passes
+    :param seed: seed of the models and the sampler
+    :return: the validation curve and the number of trained steps
+    """
+
+    settings = copy.copy(settings)
+    settings.sampling = sampling
+    seed_everything(seed)
+
+    training_controller = TrainingController(settings, StubWandbModule(settings))
+    training_controller.sampler_seed = training_controller.train_sampler.seed = seed
+    train_iterator = iter(training_controller.train)
+
+    curve = [{'seconds': 0.0, 'step': 0, **training_controller.validate()}]
+    elapsed = 0.0
+    step = 0
+    next_validation = validation_interval
+
+    while elapsed < seconds:
+        start = time.perf_counter()
+        real_he, real_p63, he_index, p63_index = next(train_iterator)
+        training_controller.training_step(real_he, real_p63, he_index, p63_index)
+
+        if training_controller.device.type == 'cuda':
+            torch.cuda.synchronize()
+
+        elapsed += time.perf_counter() - start
+        step += 1
+
+        if elapsed >= next_validation or elapsed >= seconds:
+            curve.append({'seconds': elapsed, 'step': step, **training_controller.validate()})
+            next_validation += validation_interval
+
+    return {'sampling': sampling, 'steps': step, 'seconds': elapsed, 'curve': curve}
+
+
+# training seconds until the metric first reaches target, None if it never does
+def time_to_target(curve: list[dict], metric: str, target: float):
+    for point in curve:
+        if point[metric] >= target:
+            return point['seconds']
+
+    return None
+
+
+def main():
+    parser = ArgumentParser(description='Compares validation progress per wall-clock time of uniform and '
+                                        'loss-aware tile sampling on the dataset of the settings file.')
+    parser.add_argument('--settings', type=str, default='settings.cfg', help='Settings file of the runs')
+    parser.add_argument('--seconds', type=float, default=3600, help='Training time budget of each run')
+    parser.add_argument('--validation_interval', type=float, default=300, help='Training seconds between validations')
+    parser.add_argument('--metric', type=str, default='ssim_he', help='Validation metric to compare, higher is better')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of both runs')
+    parser.add_argument('--output', type=str, help='Also write the results as json to this file')
+    args = parser.parse_args()
+
+    settings = Settings(args.settings)
+    settings.num_workers = min(settings.num_workers, os.cpu_count() or 1)
+
+    runs = [run_sampling(settings, sampling, args.seconds, args.validation_interval, args.seed)
+            for sampling in ('uniform', 'loss')]
+
+    # the final value of the uniform run is the target both runs are timed against
+    target = runs[0]['curve'][-1][args.metric]
+
+    for run in runs:
+        curve = run['curve']
+        hours = run['seconds'] / 3600
+        run['steps_per_second'] = run['steps'] / run['seconds']
+        run[f'{args.metric}_gain_per_hour'] = (curve[-1][args.metric] - curve[0][args.metric]) / hours
+        run['seconds_to_uniform_final'] = time_to_target(curve, args.metric, target)
+
+    results = {'metric': args.metric, 'target': target, 'runs': runs}
+    print(json.dumps(results, indent=4))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
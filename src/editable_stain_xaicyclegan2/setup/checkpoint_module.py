@@ -0,0 +1,161 @@
+"""
+    Prevzatý kód
+"""
+
+import glob
+import os
+import queue
+import re
+import threading
+from collections import deque
+
+import torch
+
+
+# save an object to path atomically, a crash mid-write leaves the previous file (if any) untouched
+def atomic_save(obj, path):
+    tmp_path = f"{path}.tmp"
+
+    with open(tmp_path, 'wb') as file:
+        torch.save(obj, file)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(tmp_path, path)
+
+
+# find the newest checkpoint in model_dir that can be loaded, returns (path, checkpoint) or (None, None)
+def find_latest_checkpoint(model_dir, pattern="*model_checkpoint*.pt"):
+    paths = sorted(glob.glob(os.path.join(model_dir, pattern)), key=os.path.getmtime, reverse=True)
+
+    for path in paths:
+        try:
+            checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+        except Exception as e:  # a truncated or otherwise corrupt checkpoint, try the next one
+            print(f"Skipping checkpoint {path}: {e}")
+            continue
+
+        if isinstance(checkpoint, dict) and 'generator_optimizer_state_dict' in checkpoint:
+            return path, checkpoint
+
+    return None, None
+
+
+# the periodic checkpoints of model_dir, saved as {model_step}_model_checkpoint.pt, ordered by their model step
+def find_step_checkpoints(model_dir):
+    paths = glob.glob(os.path.join(model_dir, "*_model_checkpoint.pt"))
+    steps = {path: re.fullmatch(r"(\d+)_model_checkpoint\.pt", os.path.basename(path)) for path in paths}
+
+    return sorted((path for path, match in steps.items() if match), key=lambda path: int(steps[path].group(1)))
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints on a background thread, so that training does not stall while serializing.
+    Tensors are first copied into (pinned, if cuda is available) CPU buffers, the copy is asynchronous
+    and the writer thread waits for it to finish before serializing. The buffers are reused between
+    checkpoints with the same structure. Only the last keep_last checkpoints written by the writer, or
+    by an earlier run passed as existing, are kept on disk, unless they were saved with keep=True.
+    """
+
+    def __init__(self, keep_last: int | None = None, existing: list[str] | None = None):
+        """
+        :param keep_last: number of checkpoints to keep, None keeps all of them
+        :param existing: checkpoints already on disk that fall under the retention policy, oldest first
+        """
+
+        self.keep_last = keep_last
+        self.pin_memory = torch.cuda.is_available()
+        self.buffers = {}
+        self.written = deque(existing or [])
+        self.error = None
+
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._worker, name="CheckpointWriter", daemon=True)
+        self.thread.start()
+
+    def _snapshot(self, obj, key=()):
+        if isinstance(obj, torch.Tensor):
+            buffer = self.buffers.get(key)
+
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.shape, dtype=obj.dtype, device='cpu', pin_memory=self.pin_memory)
+                self.buffers[key] = buffer
+
+            buffer.copy_(obj.detach(), non_blocking=self.pin_memory)
+            return buffer
+        elif isinstance(obj, dict):
+            return type(obj)((k, self._snapshot(v, key + (k,))) for k, v in obj.items())
+        elif isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, key + (i,)) for i, v in enumerate(obj))
+
+        return obj
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+
+            try:
+                if item is None:
+                    return
+
+                obj, path, event, keep = item
+
+                if event is not None:
+                    event.synchronize()
+
+                atomic_save(obj, path)
+
+                if not keep:
+                    self._retain(path)
+            except Exception as e:  # reported back to the training thread on the next call
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _retain(self, path):
+        if path in self.written:
+            self.written.remove(path)
+
+        self.written.append(path)
+
+        while self.keep_last is not None and len(self.written) > self.keep_last:
+            old_path = self.written.popleft()
+
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, obj: dict, path: str, keep: bool = False):
+        """
+        Snapshots obj and schedules it to be written to path.
+
+        :param obj: the checkpoint, a possibly nested dict of tensors and picklable values
+        :param path: the final path of the checkpoint
+        :param keep: exclude the checkpoint from the retention policy
+        """
+
+        # the snapshot buffers are reused, so the previous checkpoint must be written before overwriting them
+        self.wait()
+
+        snapshot = self._snapshot(obj)
+        event = None
+
+        if self.pin_memory:
+            event = torch.cuda.Event()
+            event.record()
+
+        self.queue.put((snapshot, path, event, keep))
+
+    def wait(self):
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
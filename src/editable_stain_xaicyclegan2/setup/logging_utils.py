@@ -2,6 +2,10 @@
     Prevzatý kód
 """
 
+import json
+import time
+from contextlib import nullcontext
+
 import kornia
 import numpy as np
 import torch
@@ -88,6 +92,109 @@ class RunningMeanStack(list):
         return self[0]
 
 
+# accumulates wall time of named phases per step, keeps running means over the last max_length steps
+class PhaseTimer:
+
+    def __init__(self, enabled: bool = False, max_length: int = 100, synchronize: bool = False):
+        """
+        :param enabled: when disabled, phase() returns a no-op context and nothing is synchronized
+        :param max_length: number of steps the running means are computed over
+        :param synchronize: synchronize cuda at phase boundaries, so that asynchronous kernels are attributed
+         to the phase which launched them
+        """
+
+        self.enabled = enabled
+        self.max_length = max_length
+        self.synchronize = synchronize
+        self.running = {}
+        self.current = {}
+        self.started = {}
+        self.stack = []
+        self._null = nullcontext()
+
+    def _now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    # nested phases are exclusive, the time spent in an inner phase is not counted for the outer one
+    def start(self, name):
+        if not self.enabled:
+            return
+
+        now = self._now()
+
+        if self.stack:
+            outer = self.stack[-1]
+            self.current[outer] = self.current.get(outer, 0) + now - self.started[outer]
+
+        self.stack.append(name)
+        self.started[name] = now
+
+    def stop(self, name):
+        if not self.enabled or name not in self.started:
+            return
+
+        now = self._now()
+        self.current[name] = self.current.get(name, 0) + now - self.started.pop(name)
+        self.stack.remove(name)
+
+        if self.stack:
+            self.started[self.stack[-1]] = now
+
+    def phase(self, name):
+        return _Phase(self, name) if self.enabled else self._null
+
+    def step(self):  # close the current step, a phase entered several times in a step is summed up
+        if not self.enabled:
+            return
+
+        for name, value in self.current.items():
+            self.running.setdefault(name, RunningMeanStack(self.max_length)).append(value)
+
+        self.current = {}
+
+    def means(self):
+        return {name: running.mean for name, running in self.running.items()}
+
+    def write(self, path, step):  # append the running means as a json line
+        if not self.enabled:
+            return
+
+        with open(path, 'a') as file:
+            file.write(json.dumps({'step': step, **self.means()}) + '\n')
+
+
+class _Phase:
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.start(self.name)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.timer.stop(self.name)
+
+
+# batched version of normalize_image, stays on the device of img, returns uint8 images of shape (B, H, W, C)
+def normalize_images(img):
+    img = denormalize_images(img) * 255
+    return img.permute(0, 2, 3, 1).type(torch.uint8)
+
+
+# batched conversion of normalized LAB images (B, C, H, W) to RGB in [0, 1], stays on the device of the images
+def denormalize_images(img):
+    img = img.detach().float()
+
+    # l_mean: float = 50, l_std: float = 29.59, ab_mean: float = 0, ab_std: float = 74.04
+    lum = (img[:, 0:1] * 29.59 + 50).clamp(0, 100)
+    ab = (img[:, 1:3] * 74.04).clamp(-128, 127)
+
+    return kornia.color.lab_to_rgb(torch.cat((lum, ab), dim=1))
+
+
 # return image to normal rgb appearance and value range
 def normalize_image(img, return_numpy: bool = True, squeeze: bool = True,
                     permute: bool | tuple[int, int, int, int] = True,
@@ -0,0 +1,94 @@
+"""
+    Prevzatý kód
+"""
+
+import os
+
+import torch
+
+from editable_stain_xaicyclegan2.setup.settings_module import Settings
+
+
+class ProfilerModule:
+    """
+    Wraps torch.profiler with a wait/warmup/active schedule configured in the settings file.
+    Each finished active window writes a Chrome trace, a table of the top operations and a memory
+    timeline to <log_dir>/profiler/<name>/. Does nothing unless settings.profile is True.
+    Call step() once per iteration of the profiled loop.
+    """
+
+    def __init__(self, settings: Settings, name: str):
+        self.enabled = settings.profile
+        self.out_dir = os.path.join(settings.log_dir, 'profiler', name)
+        self.profiler = None
+
+        if not self.enabled:
+            return
+
+        os.makedirs(self.out_dir, exist_ok=True)
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        self.device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+        self.sort_by = 'cuda_time_total' if torch.cuda.is_available() else 'cpu_time_total'
+
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(
+                skip_first=settings.profile_start_step,
+                wait=settings.profile_wait,
+                warmup=settings.profile_warmup,
+                active=settings.profile_active,
+                repeat=settings.profile_repeat
+            ),
+            on_trace_ready=self.trace_ready,
+            record_shapes=True,
+            profile_memory=True,
+            with_stack=True
+        )
+
+    def trace_ready(self, profiler):
+        prefix = os.path.join(self.out_dir, f'step_{profiler.step_num}')
+
+        profiler.export_chrome_trace(f'{prefix}_trace.json')
+
+        with open(f'{prefix}_top_ops.txt', 'w') as file:
+            file.write(profiler.key_averages().table(sort_by=self.sort_by, row_limit=50))
+            file.write('\n\n')
+            file.write(profiler.key_averages(group_by_input_shape=True).table(sort_by=self.sort_by, row_limit=50))
+
+        # the memory profiler is experimental and fails on some graphs, the other outputs are kept in that case
+        try:
+            self.export_memory_timeline(profiler, prefix)
+        except Exception as e:
+            print(f"Memory timeline could not be exported: {type(e).__name__}")
+
+        print("Profiler output written to: ", prefix)
+
+    def export_memory_timeline(self, profiler, prefix):
+        # the html timeline needs matplotlib, the raw timeline is written instead if it is not installed
+        try:
+            profiler.export_memory_timeline(f'{prefix}_memory.html', device=self.device)
+        except ImportError:
+            profiler.export_memory_timeline(f'{prefix}_memory.json.gz', device=self.device)
+
+    def start(self):
+        if self.profiler is not None:
+            self.profiler.start()
+
+    def step(self):
+        if self.profiler is not None:
+            self.profiler.step()
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -3,9 +3,10 @@
 """
 
 # create a data class that ingests a file with the following structure:
-# <name>=<value> where <value> can either be a "string" or a number
+# <name>=<value> where <value> can either be a "string", a number or a [list]
 # the class creates properties for each name and assigns the value to it
 
+import ast
 import re
 from typing import Literal
 
@@ -26,6 +27,20 @@ class Settings:
     mode: str
     log_frequency: int
     log_dir: str
+    visualisation_samples: int = 16
+    validation_frequency: int = None
+    validation_samples: int = 64
+    validation_batch_size: int = None
+    time_phases: bool = False
+    metrics_file: str = None
+
+    # Profiling
+    profile: bool = False
+    profile_start_step: int = 10
+    profile_wait: int = 1
+    profile_warmup: int = 1
+    profile_active: int = 3
+    profile_repeat: int = 1
 
     # Data location
     model_root: str
@@ -44,13 +59,34 @@ class Settings:
     crop: int
     flip_vertical: bool
     flip_horizontal: bool
+    augment: bool = False
+    augment_rot90: bool = True
+    augment_color_jitter: float = 0.0
+    augment_color_space: Literal['hed', 'lab'] = 'hed'
     norm_dict: dict
     channels: int
     pool_size: int
+    data_backend: Literal['folder', 'memmap', 'shards'] = 'folder'
+    shard_buffer_size: int = 1000
+    device_transform: bool = False
+    data_manifest: bool = False
+    decode_backend: Literal['pil', 'torchvision'] = 'pil'
+    tile_cache_mib: int = None
+    num_workers: int = 8
+    prefetch_factor: int = 2
+    steps_per_epoch: int = None
+    sampling: Literal['uniform', 'loss'] = 'uniform'
+    sampling_floor: float = 0.2
+    sampling_momentum: float = 0.9
 
     # Model
     checkpoint_frequency_steps: int
+    checkpoint_keep_last: int = None
+    auto_resume: bool = False
     batch_size: int
+    micro_batch_size: int = None
+    checkpoint_resnet_blocks: bool = False
+    checkpoint_decoder: bool = False
     generator_downconv_filters: int
     discriminator_downconv_filters: int
     num_resnet_blocks: int
@@ -65,10 +101,17 @@ class Settings:
     lambda_mask_cycle_ratio: float
     lambda_context: int
     lambda_cycle_context: int
+    identity_loss_schedule: float = 1
+    context_loss_schedule: float = 1
+    cycle_context_loss_schedule: float = 1
     mask_type: Literal['binary_rec', 'entropy', 'noise']
     explanation_ramp_type: str
     beta1: float
     beta2: float
+    ema_decay: float = None
+    progressive_sizes: list = None
+    progressive_milestones: list = None
+    progressive_fade_steps: int = 0
 
     def __init__(self, path):
         self.path = path
@@ -97,6 +140,8 @@ class Settings:
                         value = True
                     elif value == 'False':
                         value = False
+                    elif value.startswith('[') and value.endswith(']'):
+                        value = ast.literal_eval(value)
                     else:
                         value = value.strip('"').strip("'")
 
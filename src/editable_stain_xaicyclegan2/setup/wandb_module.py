@@ -2,11 +2,13 @@
     Prevzatý kód
 """
 
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
 import wandb
 
 from editable_stain_xaicyclegan2.setup.settings_module import Settings
-from editable_stain_xaicyclegan2.setup.logging_utils import RunningMeanStack, normalize_image
+from editable_stain_xaicyclegan2.setup.logging_utils import RunningMeanStack, normalize_images
 
 
 class WandbModule:
@@ -14,13 +16,19 @@ class WandbModule:
     This class creates a wandb run and saves the config.
     """
 
-    def __init__(self, settings: Settings):
+    def __init__(self, settings: Settings, run_id: str | None = None):
+        """
+        :param settings: settings of the run
+        :param run_id: id of a previous run to continue logging to when resuming training
+        """
+
         self.run = wandb.init(
             project=settings.project,
             group=settings.group,
             name=settings.name,
             notes=settings.notes,
-            resume=settings.resume,
+            id=run_id,
+            resume='allow' if run_id is not None else settings.resume,
             mode=settings.mode,
             dir=settings.log_dir,
             config=settings.cfg_dict
@@ -33,6 +41,10 @@ class WandbModule:
         self.log_frequency = settings.log_frequency
         self.model_file = None
 
+        # the previous image must be logged before anything with a later step, see wait_image
+        self.image_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="WandbImage")
+        self.image_future = None
+
         self.generator_he_to_p63_running_loss_avg = RunningMeanStack(self.log_frequency)
         self.generator_p63_to_he_running_loss_avg = RunningMeanStack(self.log_frequency)
         self.discriminator_he_running_loss_avg = RunningMeanStack(self.log_frequency)
@@ -40,10 +52,16 @@ class WandbModule:
         self.cycle_he_running_loss_avg = RunningMeanStack(self.log_frequency)
         self.cycle_p63_running_loss_avg = RunningMeanStack(self.log_frequency)
         self.total_running_loss_avg = RunningMeanStack(self.log_frequency)
+        self.scheduled_total_running_loss_avg = RunningMeanStack(self.log_frequency)
         self.context_running_loss_avg = RunningMeanStack(self.log_frequency)
         self.cycle_context_running_loss_avg = RunningMeanStack(self.log_frequency)
 
-    def log(self, epoch):
+    def log(self, epoch, timings: dict | None = None):
+        self.wait_image()
+
+        if timings:
+            self.run.log({f"timing/{name}": value for name, value in timings.items()}, step=self.step)
+
         self.run.log({
             "he_to_p63_generator_loss": self.generator_he_to_p63_running_loss_avg.mean,
             "p63_to_he_generator_loss": self.generator_p63_to_he_running_loss_avg.mean,
@@ -52,52 +70,62 @@ class WandbModule:
             "he_cycle_loss": self.cycle_he_running_loss_avg.mean,
             "p63_cycle_loss": self.cycle_p63_running_loss_avg.mean,
             "total_generator_loss": self.total_running_loss_avg.mean,
+            "scheduled_total_generator_loss": self.scheduled_total_running_loss_avg.mean,
             "context_loss": self.context_running_loss_avg.mean,
             "cycle_context_loss": self.cycle_context_running_loss_avg.mean,
             "epoch": epoch,
         }, step=self.step)
 
-    def log_image(self, real_image_pair, gen_image_pair, recon_image_pair):
-        # Concatenate the images horizontally to create rows
-        row_0 = np.concatenate((
-            normalize_image(real_image_pair[0]),
-            normalize_image(gen_image_pair[1]),
-            normalize_image(recon_image_pair[0]),
-        ), axis=1)
-
-        row_1 = np.concatenate((
-            normalize_image(real_image_pair[1]),
-            normalize_image(gen_image_pair[0]),
-            normalize_image(recon_image_pair[1]),
-        ), axis=1)
-
-        # Concatenate the rows vertically to create the final image
-        merged_image = np.concatenate((row_0, row_1), axis=0)
+    def log_loss_schedule(self, stats: dict):
+        self.run.log({f"loss_schedule/{name}": value for name, value in stats.items()}, step=self.step)
+
+    def log_tile_cache(self, stats: dict):
+        self.run.log({f"tile_cache/{name}": value for name, value in stats.items()}, step=self.step)
+
+    def log_validation(self, metrics: dict):
+        self.wait_image()
+        self.run.log({f"validation/{name}": value for name, value in metrics.items()}, step=self.step)
+
+    # merge the image pairs into a single uint8 composite, normalized in one batch on the device of the images
+    @staticmethod
+    def merge_images(real_image_pair, gen_image_pair, recon_image_pair):
+        images = normalize_images(torch.cat((
+            real_image_pair[0][:1], gen_image_pair[1][:1], recon_image_pair[0][:1],
+            real_image_pair[1][:1], gen_image_pair[0][:1], recon_image_pair[1][:1],
+        )))
 
+        # Concatenate the images horizontally to create rows, and the rows vertically to create the final image
+        row_0 = torch.cat(tuple(images[0:3]), dim=1)
+        row_1 = torch.cat(tuple(images[3:6]), dim=1)
+
+        return torch.cat((row_0, row_1), dim=0).cpu().numpy()
+
+    # wandb.Image encoding and logging happen on a background thread, one image at a time
+    def _log_merged_image(self, merged_image, caption, step):
         self.run.log({
-            "generation_results": wandb.Image(merged_image, caption="Top row HE->P63, Bottom P63->HE, L to R orig., transf., reconstr."),
-        }, step=self.step)
+            "generation_results": wandb.Image(merged_image, caption=caption),
+        }, step=step)
+
+    def wait_image(self):
+        if self.image_future is not None:
+            self.image_future.result()
+            self.image_future = None
+
+    def log_image(self, real_image_pair, gen_image_pair, recon_image_pair):
+        self.wait_image()
+        merged_image = self.merge_images(real_image_pair, gen_image_pair, recon_image_pair)
+        self.image_future = self.image_executor.submit(
+            self._log_merged_image, merged_image,
+            "Top row HE->P63, Bottom P63->HE, L to R orig., transf., reconstr.", self.step)
 
     def log_image_paired(self, real_image_pair, gen_image_pair, recon_image_pair):
-        # Concatenate the images horizontally to create rows
-        row_0 = np.concatenate((
-            normalize_image(real_image_pair[0]),
-            normalize_image(gen_image_pair[1]),
-            normalize_image(recon_image_pair[0]),
-        ), axis=1)
-
-        row_1 = np.concatenate((
-            normalize_image(real_image_pair[1]),
-            normalize_image(gen_image_pair[0]),
-            normalize_image(recon_image_pair[1]),
-        ), axis=1)
-
-        # Concatenate the rows vertically to create the final image
-        merged_image = np.concatenate((row_0, row_1), axis=0)
+        self.wait_image()
+        merged_image = self.merge_images(real_image_pair, gen_image_pair, recon_image_pair)
+        self.image_future = self.image_executor.submit(self._log_merged_image, merged_image, "Paired", self.step)
 
-        self.run.log({
-            "generation_results": wandb.Image(merged_image, caption="Paired"),
-        }, step=self.step)
+    def close(self):
+        self.wait_image()
+        self.image_executor.shutdown()
 
     def log_model(self, model_file):
         if self.model_file is None:
@@ -0,0 +1,104 @@
+"""
+    Prevzatý kód
+"""
+
+import json
+import os
+import random
+import tarfile
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from editable_stain_xaicyclegan2.model.dataset import get_manifest_path, get_shard_dir, load_manifest
+from editable_stain_xaicyclegan2.setup.settings_module import Settings
+
+
+# writes the tiles into one uncompressed tar, the pngs are stored as they are
+def write_shard(path: str, input_path: str, filenames: list[str]) -> int:
+    partial_path = path + '.partial'
+
+    with tarfile.open(partial_path, 'w') as tar:
+        for filename in filenames:
+            tar.add(os.path.join(input_path, filename), arcname=filename, recursive=False)
+
+    os.replace(partial_path, path)
+    return len(filenames)
+
+
+def shard_tiles(image_dir: str, sub_folder: str, shard_size: int = 1000, shuffle: bool = True, seed: int = 0,
+                workers: int = None) -> dict:
+    """
+    Packs the tiles of a folder into tar shards of shard_size tiles each, read by ShardDataset.
+    The tiles are shuffled before packing, otherwise a shard would hold neighbouring tiles of a single slide and
+    the in-shard shuffle buffer of ShardDataset could not mix the slides. If build_manifest.py was run for the
+    folder, only the valid tiles of the manifest are packed.
+
+    :param image_dir: path to the folder containing the tile folders
+    :param sub_folder: tile folder to pack, e.g. 'train/p63'
+    :param shard_size: number of tiles in a shard, the last shard may be smaller
+    :param shuffle: shuffle the tiles across the shards
+    :param seed: seed of the shuffle
+    :param workers: number of processes writing shards
+    :return: the index written into the shard directory
+    """
+
+    input_path = os.path.join(image_dir, sub_folder)
+    shard_dir = get_shard_dir(image_dir, sub_folder)
+    os.makedirs(shard_dir, exist_ok=True)
+
+    if os.path.exists(get_manifest_path(image_dir, sub_folder)):
+        filenames = np.char.decode(load_manifest(image_dir, sub_folder)['filenames']).tolist()
+    else:
+        filenames = sorted(os.listdir(input_path))
+
+    order = list(filenames)
+
+    if shuffle:
+        random.Random(seed).shuffle(order)
+
+    chunks = [order[i:i + shard_size] for i in range(0, len(order), shard_size)]
+    names = [f"shard-{i:06d}.tar" for i in range(len(chunks))]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        counts = list(executor.map(write_shard, [os.path.join(shard_dir, name) for name in names],
+                                   [input_path] * len(chunks), chunks))
+
+    index = {
+        'source': os.path.abspath(input_path),
+        'shard_size': shard_size,
+        'filenames': filenames,
+        'shards': [{'name': name, 'count': count} for name, count in zip(names, counts)]
+    }
+
+    with open(os.path.join(shard_dir, 'index.json'), 'w') as file:
+        json.dump(index, file)
+
+    return index
+
+
+def main():
+    parser = ArgumentParser(description='Packs tile folders into tar shards, used by training with '
+                                        'data_backend=\'shards\'.')
+    parser.add_argument('--settings', type=str, default='settings.cfg', help='Settings file with the data paths')
+    parser.add_argument('--folders', type=str, nargs='+', help='Tile folders in data_root to pack, '
+                                                               'by default data_train_he and data_train_p63')
+    parser.add_argument('--shard_size', type=int, default=1000, help='Number of tiles in a shard')
+    parser.add_argument('--no_shuffle', action='store_true', help='Keep the sorted order of the tiles')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the shuffle')
+    parser.add_argument('--workers', type=int, help='Number of processes writing shards')
+    args = parser.parse_args()
+
+    settings = Settings(args.settings)
+    folders = args.folders or [settings.data_train_he, settings.data_train_p63]
+
+    for folder in folders:
+        index = shard_tiles(settings.data_root, folder, args.shard_size, not args.no_shuffle, args.seed,
+                            args.workers)
+        print(f"{folder}: {len(index['filenames'])} tiles packed into {len(index['shards'])} shards in "
+              f"{get_shard_dir(settings.data_root, folder)}")
+
+
+if __name__ == '__main__':
+    main()
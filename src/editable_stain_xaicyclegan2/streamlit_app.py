@@ -23,7 +23,7 @@ else:
 
 gen = Generator(32, 8)
 model_dict = torch.load('model_checkpoint.pth')
-gen.load_state_dict(model_dict['generator_he_to_p63_state_dict'])
+gen.load_state_dict(model_dict.get('generator_he_to_p63_ema_state_dict', model_dict['generator_he_to_p63_state_dict']))
 gen = gen.to(device)
 gen.eval()
 
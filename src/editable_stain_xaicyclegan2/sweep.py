@@ -0,0 +1,457 @@
+"""
+    Prevzatý kód
+"""
+
+# runs a local hyperparameter sweep, each trial is a train.py process with its own settings file.
+# The sweep is described by a json file with the following structure:
+# {
+#     "name": "lambda_sweep",
+#     "method": "grid" | "random",
+#     "trials": 8,                                        (random only, number of sampled trials)
+#     "seed": 0,                                          (random only)
+#     "parameters": {
+#         "lambda_cycle": {"values": [5, 10, 20]},        (grid and random)
+#         "lr_generator": {"min": 1e-5, "max": 1e-3, "log": true},
+#         "num_resnet_blocks": {"min": 4, "max": 9, "int": true}
+#     },
+#     "settings": {"epochs": 1, "steps_per_epoch": 2000}  (fixed overrides of every trial)
+# }
+
+import itertools
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from editable_stain_xaicyclegan2.model.dataset import get_manifest_path, get_shard_dir, get_tile_store_paths, \
+    load_manifest
+from editable_stain_xaicyclegan2.pack_tiles import pack_tiles
+from editable_stain_xaicyclegan2.setup.settings_module import Settings
+from editable_stain_xaicyclegan2.shard_tiles import shard_tiles
+
+
+# format a value the way the settings file parser reads it back
+def format_setting_value(value):
+    if value is None or isinstance(value, bool):
+        return str(value)
+    elif isinstance(value, int):
+        return str(value)
+    elif isinstance(value, float):
+        return np.format_float_positional(value, trim='0')
+    elif isinstance(value, (list, tuple)):
+        return repr(list(value))
+
+    return f'"{value}"'
+
+
+# copy a settings file, replacing the values in overrides and keeping the wandb config stars
+def write_settings(base_path, path, overrides: dict):
+    remaining = dict(overrides)
+    lines = []
+
+    for name in remaining:
+        if name not in Settings.__dict__['__annotations__'].keys():
+            raise KeyError(f"Unknown setting: {name}")
+
+    with open(base_path, 'r') as file:
+        for line in file:
+            stripped = line.strip()
+
+            if stripped and not stripped.startswith('#') and '=' in stripped:
+                name = stripped.split('=')[0].strip()
+
+                if name.lstrip('*') in remaining:
+                    line = f"{name}={format_setting_value(remaining.pop(name.lstrip('*')))}\n"
+
+            lines.append(line)
+
+    if remaining:
+        lines.append('\n# Sweep\n')
+        lines.extend(f"{name}={format_setting_value(value)}\n" for name, value in remaining.items())
+
+    with open(path, 'w') as file:
+        file.writelines(lines)
+
+
+# all combinations of the listed values
+def expand_grid(parameters: dict) -> list[dict]:
+    for name, space in parameters.items():
+        if 'values' not in space:
+            raise ValueError(f"Grid parameter {name} needs a list of values")
+
+    names = list(parameters)
+    return [dict(zip(names, values)) for values in itertools.product(*(parameters[name]['values'] for name in names))]
+
+
+def sample_parameter(space: dict, rng: random.Random):
+    if 'values' in space:
+        return rng.choice(space['values'])
+
+    low, high = space['min'], space['max']
+
+    if space.get('log', False):
+        value = math.exp(rng.uniform(math.log(low), math.log(high)))
+    else:
+        value = rng.uniform(low, high)
+
+    return int(round(value)) if space.get('int', False) else value
+
+
+def sample_random(parameters: dict, num_trials: int, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    return [{name: sample_parameter(space, rng) for name, space in parameters.items()} for _ in range(num_trials)]
+
+
+# files the training datasets of the settings read, the tile stores and shards are built first if missing
+def get_dataset_files(settings: Settings) -> list[str]:
+    paths = []
+
+    for sub_folder in (settings.data_train_he, settings.data_train_p63):
+        if settings.data_backend == 'memmap':
+            store_path, _ = get_tile_store_paths(settings.data_root, sub_folder)
+
+            if not os.path.exists(store_path):
+                pack_tiles(settings.data_root, sub_folder)
+
+            paths.append(store_path)
+        elif settings.data_backend == 'shards':
+            shard_dir = get_shard_dir(settings.data_root, sub_folder)
+
+            if not os.path.exists(os.path.join(shard_dir, 'index.json')):
+                shard_tiles(settings.data_root, sub_folder)
+
+            with open(os.path.join(shard_dir, 'index.json'), 'r') as file:
+                paths.extend(os.path.join(shard_dir, shard['name']) for shard in json.load(file)['shards'])
+        else:
+            folder = os.path.join(settings.data_root, sub_folder)
+
+            # with a manifest the trials only open its tiles, e.g. without the pruned duplicates
+            if settings.data_manifest and os.path.exists(get_manifest_path(settings.data_root, sub_folder)):
+                filenames = np.char.decode(load_manifest(settings.data_root, sub_folder)['filenames']).tolist()
+            else:
+                filenames = os.listdir(folder) if os.path.isdir(folder) else []
+
+            paths.extend(os.path.join(folder, filename) for filename in filenames)
+
+    return paths
+
+
+# read the training data once in the form the trials load it, so that they start with it in the OS page cache
+def warm_dataset_cache(settings: Settings, workers: int = 8, chunk_size: int = 16 * 2 ** 20):
+    paths = get_dataset_files(settings)
+
+    # read in chunks, a tile store is a single file of several GiB
+    def read(path):
+        size = 0
+
+        with open(path, 'rb') as file:
+            while chunk := file.read(chunk_size):
+                size += len(chunk)
+
+        return size
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        total = sum(executor.map(read, paths))
+
+    print(f"Dataset cache warmed ({settings.data_backend}): {len(paths)} files, {total / 2 ** 30:.2f} GiB "
+          f"in {time.perf_counter() - start:.1f} s")
+
+
+class SweepTrial:
+
+    def __init__(self, index: int, parameters: dict, trial_dir: str):
+        """
+        :param index: index of the trial in the sweep
+        :param parameters: sampled values of the swept settings
+        :param trial_dir: directory for the settings, logs and metrics of the trial
+        """
+
+        self.index = index
+        self.parameters = parameters
+        self.trial_dir = trial_dir
+        self.settings_path = os.path.join(trial_dir, 'settings.cfg')
+        self.metrics_path = os.path.join(trial_dir, 'metrics.jsonl')
+        self.log_path = os.path.join(trial_dir, 'train.log')
+
+        self.process = None
+        self.log_file = None
+        self.status = 'pending'
+        self.returncode = None
+        self.start_time = None
+        self.end_time = None
+        self.values = []  # objective value of every metrics report, smoothed
+        self.reports = []
+        self.read_offset = 0
+
+    # read the metrics reports written since the last call
+    def read_metrics(self, metric: str, window: int):
+        if not os.path.exists(self.metrics_path):
+            return
+
+        with open(self.metrics_path, 'r') as file:
+            file.seek(self.read_offset)
+            data = file.read()
+
+        # only complete lines, the trial may be in the middle of writing one
+        complete = data[:data.rfind('\n') + 1]
+        self.read_offset += len(complete.encode())
+
+        # losses and validation results are separate reports, only the ones with the metric are compared
+        for line in complete.splitlines():
+            report = json.loads(line)
+
+            if report.get(metric) is None:
+                continue
+
+            self.reports.append(report)
+            self.values.append(statistics.fmean(r[metric] for r in self.reports[-window:]))
+
+    def best(self, mode: str):
+        values = [value for value in self.values if not math.isnan(value)]
+
+        if not values:
+            return None
+
+        return min(values) if mode == 'min' else max(values)
+
+    def row(self, mode: str) -> dict:
+        return {
+            'trial': self.index,
+            'status': self.status,
+            'returncode': self.returncode,
+            **self.parameters,
+            'reports': len(self.reports),
+            'last': self.values[-1] if self.values else None,
+            'best': self.best(mode),
+            'seconds': (self.end_time or time.time()) - self.start_time if self.start_time else None,
+            'settings': self.settings_path
+        }
+
+
+class SweepRunner:
+    """
+    Runs the trials of a sweep as parallel local train.py processes, limiting the threads of each.
+    A trial is terminated early if its smoothed objective at a report is worse than the median of
+    the other trials at the same report (median stopping), or if it is nan. The state of all trials
+    is written to <out_dir>/<name>/results.csv whenever a trial finishes.
+    """
+
+    def __init__(self, spec: dict, base_settings: str, out_dir: str, parallel: int = 2, threads: int = 1,
+                 num_workers: int = 2, devices: list[str] | None = None, metric: str = 'cycle', mode: str = 'min',
+                 grace_reports: int = 5, min_peers: int = 2, window: int = 5, poll_interval: float = 10.0):
+        """
+        :param spec: the sweep description, see the top of this file
+        :param base_settings: settings file the trials start from
+        :param out_dir: directory the sweep directory is created in
+        :param parallel: number of trials running at once
+        :param threads: number of intra-op threads of each trial
+        :param num_workers: number of data loader workers of each trial
+        :param devices: cuda devices the trials are assigned to round-robin, None leaves them visible
+        :param metric: loss or validation result in the metrics file the trials are compared on, e.g. cycle or ssim_he
+        :param mode: whether the metric is minimized or maximized
+        :param grace_reports: number of reports before a trial can be terminated
+        :param min_peers: number of other trials with a report at the same index needed to terminate a trial
+        :param window: number of reports the metric is averaged over
+        :param poll_interval: seconds between checks of the running trials
+        """
+
+        self.spec = spec
+        self.name = spec.get('name', 'sweep')
+        self.base_settings = base_settings
+        self.sweep_dir = os.path.join(out_dir, self.name)
+        self.parallel = parallel
+        self.threads = threads
+        self.num_workers = num_workers
+        self.devices = devices
+        self.metric = metric
+        self.mode = mode
+        self.grace_reports = grace_reports
+        self.min_peers = min_peers
+        self.window = window
+        self.poll_interval = poll_interval
+
+        if spec.get('method', 'grid') == 'grid':
+            parameters = expand_grid(spec['parameters'])
+        else:
+            parameters = sample_random(spec['parameters'], spec.get('trials', 10), spec.get('seed', 0))
+
+        self.trials = [
+            SweepTrial(index, trial_parameters, os.path.join(self.sweep_dir, f'trial_{index:03d}'))
+            for index, trial_parameters in enumerate(parameters)
+        ]
+
+    def prepare(self, trial: SweepTrial):
+        os.makedirs(trial.trial_dir, exist_ok=True)
+
+        overrides = {
+            **self.spec.get('settings', {}),
+            **trial.parameters,
+            'name': f'{self.name}_{trial.index:03d}',
+            'group': self.name,
+            'mode': self.spec.get('wandb_mode', 'disabled'),
+            'log_dir': trial.trial_dir,
+            'model_root': os.path.join(self.sweep_dir, 'models'),
+            'metrics_file': trial.metrics_path,
+            'num_workers': self.num_workers,
+            'auto_resume': False
+        }
+
+        write_settings(self.base_settings, trial.settings_path, overrides)
+
+        # a rerun of the sweep starts the trial from scratch
+        if os.path.exists(trial.metrics_path):
+            os.remove(trial.metrics_path)
+
+    def launch(self, trial: SweepTrial):
+        self.prepare(trial)
+
+        env = dict(os.environ)
+
+        for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+            env[variable] = str(self.threads)
+
+        if self.devices:
+            env['CUDA_VISIBLE_DEVICES'] = self.devices[trial.index % len(self.devices)]
+
+        trial.log_file = open(trial.log_path, 'w')
+        trial.process = subprocess.Popen(
+            [sys.executable, '-m', 'editable_stain_xaicyclegan2.train', '--settings', trial.settings_path],
+            stdout=trial.log_file, stderr=subprocess.STDOUT, env=env
+        )
+        trial.status = 'running'
+        trial.start_time = time.time()
+
+        print(f"Trial {trial.index} started: {trial.parameters}")
+
+    def is_worse(self, value, reference):
+        return value > reference if self.mode == 'min' else value < reference
+
+    # median stopping rule, compares the trial to all other trials that reached the same report
+    def should_stop(self, trial: SweepTrial) -> bool:
+        if not trial.values:
+            return False
+
+        if math.isnan(trial.values[-1]):
+            return True
+
+        report = len(trial.values) - 1
+
+        if report < self.grace_reports:
+            return False
+
+        peers = [other.values[report] for other in self.trials
+                 if other is not trial and len(other.values) > report and not math.isnan(other.values[report])]
+
+        if len(peers) < self.min_peers:
+            return False
+
+        return self.is_worse(trial.values[report], statistics.median(peers))
+
+    def finish(self, trial: SweepTrial, status: str):
+        trial.returncode = trial.process.poll()
+        trial.status = status
+        trial.end_time = time.time()
+        trial.log_file.close()
+        trial.read_metrics(self.metric, self.window)
+        self.write_results()
+
+        print(f"Trial {trial.index} {status}, best {self.metric}: {trial.best(self.mode)}")
+
+    def write_results(self):
+        results = pd.DataFrame([trial.row(self.mode) for trial in self.trials])
+        results.to_csv(os.path.join(self.sweep_dir, 'results.csv'), index=False)
+
+    def run(self, warm_cache: bool = True) -> pd.DataFrame:
+        os.makedirs(self.sweep_dir, exist_ok=True)
+
+        with open(os.path.join(self.sweep_dir, 'sweep.json'), 'w') as file:
+            json.dump(self.spec, file, indent=4)
+
+        if warm_cache:
+            warm_dataset_cache(Settings(self.base_settings))
+
+        pending = list(self.trials)
+        running = []
+
+        try:
+            while pending or running:
+                while pending and len(running) < self.parallel:
+                    trial = pending.pop(0)
+                    self.launch(trial)
+                    running.append(trial)
+
+                time.sleep(self.poll_interval)
+
+                for trial in list(running):
+                    trial.read_metrics(self.metric, self.window)
+
+                    if trial.process.poll() is not None:
+                        self.finish(trial, 'finished' if trial.process.returncode == 0 else 'failed')
+                        running.remove(trial)
+                    elif self.should_stop(trial):
+                        trial.process.terminate()
+                        trial.process.wait()
+                        self.finish(trial, 'stopped')
+                        running.remove(trial)
+        finally:
+            for trial in running:
+                trial.process.terminate()
+                trial.process.wait()
+                self.finish(trial, 'interrupted')
+
+        self.write_results()
+        return pd.DataFrame([trial.row(self.mode) for trial in self.trials])
+
+
+def main():
+    parser = ArgumentParser(description='Runs a local hyperparameter sweep of train.py processes.')
+    parser.add_argument('spec', type=str, help='Json file describing the sweep')
+    parser.add_argument('--settings', type=str, default='settings.cfg', help='Settings file the trials start from')
+    parser.add_argument('--out_dir', type=str, default='sweeps', help='Directory the sweep directory is created in')
+    parser.add_argument('--parallel', type=int, default=2, help='Number of trials running at once')
+    parser.add_argument('--threads', type=int, help='Threads of each trial, by default the cores are split evenly')
+    parser.add_argument('--num_workers', type=int, default=2, help='Data loader workers of each trial')
+    parser.add_argument('--devices', type=str, help='Comma separated cuda devices, assigned round-robin')
+    parser.add_argument('--metric', type=str, default='cycle', help='Loss or validation result to compare on, e.g. cycle or ssim_he (with --mode max)')
+    parser.add_argument('--mode', type=str, default='min', choices=['min', 'max'], help='Minimize or maximize')
+    parser.add_argument('--grace_reports', type=int, default=5, help='Reports before a trial can be stopped')
+    parser.add_argument('--min_peers', type=int, default=2, help='Trials to compare with before stopping one')
+    parser.add_argument('--poll_interval', type=float, default=10.0, help='Seconds between checks of the trials')
+    parser.add_argument('--no_warm_cache', action='store_true', help='Do not read the dataset once before starting')
+    args = parser.parse_args()
+
+    with open(args.spec, 'r') as file:
+        spec = json.load(file)
+
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.parallel)
+
+    runner = SweepRunner(
+        spec, args.settings, args.out_dir,
+        parallel=args.parallel,
+        threads=threads,
+        num_workers=args.num_workers,
+        devices=args.devices.split(',') if args.devices else None,
+        metric=args.metric,
+        mode=args.mode,
+        grace_reports=args.grace_reports,
+        min_peers=args.min_peers,
+        poll_interval=args.poll_interval
+    )
+
+    results = runner.run(warm_cache=not args.no_warm_cache)
+    print(results.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
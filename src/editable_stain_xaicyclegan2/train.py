@@ -2,7 +2,9 @@
     Prevzatý kód
 """
 
+import json
 import os
+from argparse import ArgumentParser
 
 import torch
 import wandb
@@ -10,37 +12,66 @@ from datetime import datetime
 
 from editable_stain_xaicyclegan2.model.dataset import DefaultTransform
 from editable_stain_xaicyclegan2.model.training_controller import TrainingController
+from editable_stain_xaicyclegan2.setup.checkpoint_module import CheckpointWriter, atomic_save, find_latest_checkpoint, \
+    find_step_checkpoints
+from editable_stain_xaicyclegan2.setup.profiler_module import ProfilerModule
 from editable_stain_xaicyclegan2.setup.wandb_module import WandbModule
 from editable_stain_xaicyclegan2.setup.settings_module import Settings
 
 
-def save_model(epoch, model_dir, training_controller, wandb_module, settings, prefix="", suffix=""):
-    torch.save({
+def save_model(epoch, model_dir, training_controller, wandb_module, settings, prefix="", suffix="",
+               checkpoint_writer: CheckpointWriter = None, keep: bool = False, step=None, model_step=None):
+    checkpoint = {
         'epoch': epoch,
+        'step': step,
+        'model_step': model_step,
         'wandb_step': wandb_module.step,
+        'wandb_run_id': wandb_module.run.id,
         'generator_he_to_p63_state_dict': training_controller.generator_he_to_p63.state_dict(),
         'generator_p63_to_he_state_dict': training_controller.generator_p63_to_he.state_dict(),
         'discriminator_he_state_dict': training_controller.discriminator_he.state_dict(),
         'discriminator_p63_state_dict': training_controller.discriminator_p63.state_dict(),
         'discriminator_he_mask_state_dict': training_controller.discriminator_he_mask.state_dict(),
         'discriminator_p63_mask_state_dict': training_controller.discriminator_p63_mask.state_dict(),
-        'generator_optimizer_state_dict': training_controller.generator_optimizer.state_dict(),
-        'discriminator_he_optimizer_state_dict': training_controller.discriminator_he_optimizer.state_dict(),
-        'discriminator_p63_optimizer_state_dict': training_controller.discriminator_p63_optimizer.state_dict(),
         'generator_loss': training_controller.latest_generator_loss,
         'discriminator_he_loss': training_controller.latest_discriminator_he_loss,
         'discriminator_p63_loss': training_controller.latest_discriminator_p63_loss,
-        'settings': settings
-    }, f=os.path.join(model_dir, f"{prefix}model_checkpoint{suffix}.pt"))
+        'settings': settings,
+        **training_controller.get_training_state()
+    }
+    path = os.path.join(model_dir, f"{prefix}model_checkpoint{suffix}.pt")
+
+    # the writer serializes on a background thread, without it the checkpoint is written synchronously
+    if checkpoint_writer is not None:
+        checkpoint_writer.save(checkpoint, path, keep=keep)
+    else:
+        atomic_save(checkpoint, path)
 
 
-def main():
+# append the latest losses as a json line, read e.g. by the sweep runner
+def write_metrics(metrics_file, epoch, step, training_controller, wandb_module):
+    metrics = {
+        'wandb_step': wandb_module.step,
+        'epoch': epoch,
+        'step': step,
+        'generator': training_controller.latest_generator_loss,
+        'generator_scheduled': training_controller.latest_scheduled_generator_loss,
+        'discriminator_he': training_controller.latest_discriminator_he_loss,
+        'discriminator_p63': training_controller.latest_discriminator_p63_loss,
+        'cycle': training_controller.latest_cycle_loss,
+        'identity': training_controller.latest_identity_loss,
+        'context': training_controller.latest_context_loss,
+        'cycle_context': training_controller.latest_cycle_context_loss
+    }
+
+    with open(metrics_file, 'a') as file:
+        file.write(json.dumps(metrics) + '\n')
+
+
+def main(settings_path="settings.cfg"):
     # settings = Settings('settings_test.cfg')
 
-    settings = Settings("settings.cfg")
-    wandb_module = WandbModule(settings)
-    training_controller = TrainingController(settings, wandb_module)
-    step_max = min(len(training_controller.train_he), len(training_controller.train_p63))
+    settings = Settings(settings_path)
     # Directories for loading data and saving results
     data_dir = settings.data_root
     model_dir = settings.model_root
@@ -57,20 +88,91 @@ def main():
         print("Model checkpoint file: ", model_file)
     else:
         exit(1)
-    model_step = 0
+
+    # Resume from the latest loadable checkpoint of this run, e.g. after the job was preempted
+    checkpoint_file, checkpoint = find_latest_checkpoint(model_dir) if settings.auto_resume else (None, None)
+    resume = checkpoint is not None and checkpoint.get('step') is not None
+
+    if resume:
+        print("Resuming from checkpoint: ", checkpoint_file)
+        wandb_module = WandbModule(settings, run_id=checkpoint.get('wandb_run_id'))
+        wandb_module.step = checkpoint['wandb_step']
+        training_controller = TrainingController(settings, wandb_module, checkpoint, resume=True)
+        start_epoch = checkpoint['epoch']
+        start_step = checkpoint['step'] + 1
+        model_step = checkpoint['model_step'] + 1
+    else:
+        wandb_module = WandbModule(settings)
+        training_controller = TrainingController(settings, wandb_module)
+        start_epoch = 0
+        start_step = 0
+        model_step = 0
+
+    del checkpoint
+
+    if start_epoch >= settings.epochs:
+        print("Training already finished: ", checkpoint_file)
+        return
+
+    step_max = training_controller.steps_per_epoch
+    timer = training_controller.timer
+    timings_file = os.path.join(log_dir, f'{settings.name}_phase_timings.jsonl')
     start = datetime.now()
+    # only the checkpoints of the resumed run fall under the retention policy, a fresh run leaves older ones alone
+    checkpoint_writer = CheckpointWriter(settings.checkpoint_keep_last,
+                                         find_step_checkpoints(model_dir) if resume else None)
+    profiler = ProfilerModule(settings, 'train')
+    profiler.start()
+
+    # Continue mid-epoch after resuming, the sampler skips the batches that were already trained on.
+    # The iterator is created once, so the workers live for the whole run
+    training_controller.set_position(start_epoch, start_step)
+    train_iterator = iter(training_controller.train)
+
+    for epoch in range(start_epoch, settings.epochs):
+        first_step = start_step if epoch == start_epoch else 0
 
-    for epoch in range(settings.epochs):
         # Iterate over the dataset
-        for step, (real_he, real_p63) in enumerate(zip(training_controller.train_he, training_controller.train_p63)):
+        for step in range(first_step, step_max):
+            timer.start('data_wait')
+            real_he, real_p63, he_index, p63_index = next(train_iterator)
+            timer.stop('data_wait')
 
             # Train the model one step
-            training_controller.training_step(real_he, real_p63)
+            training_controller.training_step(real_he, real_p63, he_index, p63_index)
+            profiler.step()
+
+            # Validate on the cached test subset every validation_frequency steps
+            if settings.validation_frequency and training_controller.global_step % settings.validation_frequency == 0:
+                timer.start('validation')
+                validation = training_controller.validate()
+                wandb_module.log_validation(validation)
+                timer.stop('validation')
+                print(f'Validation: {validation}')
+
+                if settings.metrics_file:
+                    with open(settings.metrics_file, 'a') as file:
+                        file.write(json.dumps({'wandb_step': wandb_module.step, 'epoch': epoch, 'step': step,
+                                               **validation}) + '\n')
 
             if step % settings.log_frequency == 0:  # Log every n steps
-                wandb_module.log(epoch)
+                timer.start('wandb_logging')
+                wandb_module.log(epoch, timer.means())
+                wandb_module.log_loss_schedule(training_controller.get_loss_schedule_stats())
+
+                tile_cache_stats = training_controller.get_tile_cache_stats()
+
+                if tile_cache_stats:
+                    wandb_module.log_tile_cache(tile_cache_stats)
+
                 wandb_module.log_image(*training_controller.get_image_pairs())
+                timer.write(timings_file, wandb_module.step)
+
+                if settings.metrics_file:
+                    write_metrics(settings.metrics_file, epoch, step, training_controller, wandb_module)
+
                 wandb_module.step += 1
+                timer.stop('wandb_logging')
                 curr_time = datetime.now()
                 time_diff = curr_time - start
                 time_diff_minutes = time_diff.total_seconds() / 60
@@ -89,23 +191,34 @@ def main():
 
                 # Save model checkpoint
                 if wandb_module.step % settings.checkpoint_frequency_steps == 0:
-                    save_model(epoch, model_dir, training_controller, wandb_module, settings, prefix=f"{model_step}_")
+                    save_model(epoch, model_dir, training_controller, wandb_module, settings, prefix=f"{model_step}_",
+                               checkpoint_writer=checkpoint_writer, step=step, model_step=model_step)
                     model_step += 1
 
+    profiler.stop()
     print("Finished ", datetime.now())
 
     # check if real_he and real_p63 exist in memory.
     # We can't reference them directly by variable name since they may be undefined.
     if 'real_he' not in locals() or 'real_p63' not in locals():
+        checkpoint_writer.close()
+        wandb_module.close()
         exit(1)
 
     # Export the generator_he_to_p63 model
-    save_model(0, model_dir, training_controller, wandb_module, settings, prefix="final_")
+    save_model(settings.epochs, model_dir, training_controller, wandb_module, settings, prefix="final_",
+               checkpoint_writer=checkpoint_writer, keep=True, step=-1, model_step=model_step - 1)
+    checkpoint_writer.close()
+    wandb_module.close()
 
 
 if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--settings', type=str, default='settings.cfg', help='Settings file of the run')
+    args = parser.parse_args()
+
     try:
-        main()
+        main(args.settings)
     except KeyboardInterrupt:
         wandb.finish(0)
     except Exception as e: